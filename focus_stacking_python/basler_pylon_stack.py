@@ -1,64 +1,89 @@
-from pypylon import pylon
 import time
-import urllib.request
 import os
+import sys
+
+# The fusion engine lives next to the panorama scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "panorama_python"))
+from camera import PylonCamera, SimulatedStage, SyntheticCamera
+from focus_fusion import save_fused, stack_fuser
+from frame_store import FrameStore
+from preview import Preview
+from settle import SettleDetector
+from slice_registration import SliceAligner
+from stage import StageAxis
 
 
 num_img_to_save = 10
 stepper_steps_per = 20
-
-
-imageWindow = pylon.PylonImageWindow()
-imageWindow.Create(1)
-
-img = pylon.PylonImage()
-tlf = pylon.TlFactory.GetInstance()
-
-cam = pylon.InstantCamera(tlf.CreateFirstDevice())
-cam.Open()
-print("Using device ", cam.GetDeviceInfo().GetModelName())
-
-
-
-# Set the Exposure Auto auto function to its minimum lower limit
-# and its maximum upper limit
-minLowerLimit = cam.AutoExposureTimeLowerLimitRaw.Min
-maxUpperLimit = cam.AutoExposureTimeUpperLimitRaw.Max
-cam.AutoExposureTimeLowerLimitRaw.Value = minLowerLimit
-cam.AutoExposureTimeUpperLimitRaw.Value = maxUpperLimit
-# Set the target brightness value to 128
-cam.AutoTargetValue.Value = 128
-# Select auto function ROI 1
-cam.AutoFunctionAOISelector.Value = "AOI1"
-# Enable the 'Intensity' auto function (Gain Auto + Exposure Auto)
-# for the auto function ROI selected
-cam.AutoFunctionAOIUsageIntensity.Value = True
-# Enable Exposure Auto by setting the operating mode to Continuous
-cam.ExposureAuto.Value = "Continuous"
-
-cam.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
+camera_backend = "pylon" # "pylon" (Basler camera, Pico W stage) or "synthetic" (simulated camera and stage, no hardware)
+
+
+# Live view on its own thread, never holds up the stack
+preview = Preview(max_fps=10, scale=0.25)
+
+# Frames are converted into the camera's ring buffers, nothing is
+# allocated per slice
+if camera_backend == "synthetic":
+    # The stack sweeps through the simulated focus surface
+    z_stage = SimulatedStage("z", position=-num_img_to_save*stepper_steps_per//2)
+    cam = SyntheticCamera(z_stage, preview=preview)
+else:
+    z_stage = StageAxis("http://192.168.1.70/z_move")
+    cam = PylonCamera(preview=preview)
+    camera = cam.camera
+
+    # Set the Exposure Auto auto function to its minimum lower limit
+    # and its maximum upper limit
+    minLowerLimit = camera.AutoExposureTimeLowerLimitRaw.Min
+    maxUpperLimit = camera.AutoExposureTimeUpperLimitRaw.Max
+    camera.AutoExposureTimeLowerLimitRaw.Value = minLowerLimit
+    camera.AutoExposureTimeUpperLimitRaw.Value = maxUpperLimit
+    # Set the target brightness value to 128
+    camera.AutoTargetValue.Value = 128
+    # Select auto function ROI 1
+    camera.AutoFunctionAOISelector.Value = "AOI1"
+    # Enable the 'Intensity' auto function (Gain Auto + Exposure Auto)
+    # for the auto function ROI selected
+    camera.AutoFunctionAOIUsageIntensity.Value = True
+    # Enable Exposure Auto by setting the operating mode to Continuous
+    camera.ExposureAuto.Value = "Continuous"
 
 
 
 timestr = time.strftime("%Y%m%d-%H%M%S")
 if not os.path.exists(timestr):
     os.makedirs(timestr)
-    
-for i in range(num_img_to_save):
-    with cam.RetrieveResult(0, pylon.TimeoutHandling_Return) as result:
-    
-        imageWindow.SetImage(result)
-        imageWindow.Show()
-    
-        # Calling AttachGrabResultBuffer creates another reference to the
-        # grab result buffer. This prevents the buffer's reuse for grabbing.
-        img.AttachGrabResultBuffer(result)
-        filename = timestr+"/stack_"+str(i)+".png"
-        #img.Save(pylon.ImageFileFormat_Tiff, filename)
-        img.Save(pylon.ImageFileFormat_Png, filename)
-        img.Release()
-
-
-    urllib.request.urlopen("http://192.168.1.70/z_move?steps="+str(stepper_steps_per)+"&dir=pos").read()
-    time.sleep(3)
 
+# Raw slices go into a memory-mapped store, no PNG encoding while capturing
+store = FrameStore(timestr+"/stack", num_img_to_save)
+# Slices are warped onto the first one to cancel focus breathing
+aligner = SliceAligner()
+# The next slice waits until the image is still after the z move
+settle = SettleDetector(log_path=timestr+"/settle_times.csv")
+
+for i in range(num_img_to_save):
+    frame = cam.grab_frame()
+    if frame is None:
+        print(f"Missed frame for slice {i}")
+    else:
+        with frame:
+            store.push(aligner.align(frame.array, i*stepper_steps_per), i*stepper_steps_per)
+
+
+    z_stage.move(stepper_steps_per)
+    settle.wait(cam, "z", stepper_steps_per)
+
+store.close()
+settle.report()
+cam.report()
+cam.close()
+preview.close()
+
+if len(store) > 0:
+    print("Fusing stack")
+    store = FrameStore.open(timestr+"/stack")
+    fuser = stack_fuser(store.stack(), "argmax", store.z_positions)
+    # Slice offsets are in stage steps, so the height map is too
+    save_fused(fuser, timestr+"/fused.png", height_map=True)
+else:
+    print("No frames captured, nothing to fuse")
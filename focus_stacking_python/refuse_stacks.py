@@ -0,0 +1,109 @@
+import argparse
+import glob
+import os
+import re
+import sys
+import time
+import cv2
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# The fusion engine lives next to the panorama scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "panorama_python"))
+from focus_fusion import fusion_modes, make_fuser, save_fused
+from frame_store import FrameStore
+
+
+# Batch re-fusion of saved stack directories, as left behind by
+# basler_pylon_stack.py: either stack_N.png files or a raw frame store
+# (stack.raw + stack.json). Every directory is fused on its own worker
+# process; directories whose output is newer than all of their inputs are
+# skipped, so an interrupted run just picks up where it stopped.
+#
+#   python refuse_stacks.py captures/ --mode pyramid --height-maps
+
+def stack_inputs(stack_dir):
+    # Input files of a stack directory in slice order, empty if it is none
+    if os.path.exists(os.path.join(stack_dir, "stack.json")):
+        return [os.path.join(stack_dir, "stack.json"), os.path.join(stack_dir, "stack.raw")]
+    files = glob.glob(os.path.join(stack_dir, "stack_*.png"))
+    files.sort(key=lambda f: int(re.findall(r"stack_(\d+)", os.path.basename(f))[0]))
+    return files
+
+
+def find_stacks(roots):
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            if stack_inputs(dirpath):
+                yield dirpath
+
+
+def is_up_to_date(stack_dir, output, height_maps=False):
+    out_path = os.path.join(stack_dir, output)
+    out_paths = [out_path]
+    if height_maps:
+        # Named like save_fused() names it
+        out_paths.append(out_path.rsplit(".", 1)[0] + "_height.png")
+    if not all(os.path.exists(f) for f in out_paths):
+        return False
+    newest_input = max(os.path.getmtime(f) for f in stack_inputs(stack_dir))
+    return min(os.path.getmtime(f) for f in out_paths) >= newest_input
+
+
+def refuse_stack(stack_dir, output, mode, height_maps):
+    start = time.perf_counter()
+    inputs = stack_inputs(stack_dir)
+    fuser = make_fuser(mode, track_depth=height_maps)
+
+    if inputs[0].endswith("stack.json"):
+        store = FrameStore.open(os.path.join(stack_dir, "stack"))
+        for k in range(len(store)):
+            fuser.push(store[k], store.z_positions[k])
+    else:
+        # PNG stacks carry no z, heights come out in slice units.
+        # Slices are read one at a time, argmax mode never holds the stack.
+        for k, f in enumerate(inputs):
+            fuser.push(cv2.imread(f), k)
+
+    save_fused(fuser, os.path.join(stack_dir, output), height_maps)
+    return stack_dir, len(fuser), time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-fuse saved focus-stack directories in parallel")
+    parser.add_argument("roots", nargs="+", help="Directories searched recursively for stacks")
+    parser.add_argument("--mode", choices=fusion_modes, default="argmax")
+    parser.add_argument("--output", default="fused.png", help="File name of the fused image inside each stack directory")
+    parser.add_argument("--height-maps", action="store_true", help="Also write <output>_height.png")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--force", action="store_true", help="Re-fuse even if the output is newer than the inputs")
+    args = parser.parse_args()
+
+    stacks = list(find_stacks(args.roots))
+    todo = [d for d in stacks if args.force or not is_up_to_date(d, args.output, args.height_maps)]
+    print(f"Found {len(stacks)} stacks, {len(stacks) - len(todo)} up to date, fusing {len(todo)} on {args.workers} workers")
+    if not todo:
+        return
+
+    start = time.perf_counter()
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(refuse_stack, d, args.output, args.mode, args.height_maps): d for d in todo}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                stack_dir, slices, seconds = future.result()
+                print(f"[{done}/{len(todo)}] {stack_dir}: {slices} slices in {seconds:.1f} s")
+            except Exception as e:
+                failed += 1
+                print(f"[{done}/{len(todo)}] {futures[future]}: failed: {e}")
+
+    elapsed = time.perf_counter() - start
+    fused = len(todo) - failed
+    print(f"Fused {fused} stacks in {elapsed:.1f} s, {fused / elapsed * 60:.1f} stacks per minute")
+    if failed:
+        print(f"{failed} stacks failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
-from pypylon import pylon
 import time
-import urllib.request
 import os
-import cv2
-import numpy as np
+
+from camera import PylonCamera, SimulatedStage, SyntheticCamera
+from focus_frames import FocusFrames
+from focus_map import FocusMap
+from focus_metrics import FocusMetric
+from focus_search import FocusProbe, fit_peak, log_search, make_search
+from preview import Preview
+from settle import SettleDetector, SettleTable
+from save_pipeline import SavePipeline
+from stage import StageAxis
+from tile_formats import ScanStore
 
 
 #AD7177
@@ -27,60 +34,36 @@ y_step_count = 20
 
 autofocus_range = 200  # Total range (in steps) to search for focus
 autofocus_step_size = 20 # Smaller step size for autofocusing
-
-imageWindow = pylon.PylonImageWindow()
-imageWindow.Create(1)
-
-img = pylon.PylonImage()
-
-cam = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
-
-# Register the standard configuration event handler for enabling software triggering.
-# The software trigger configuration handler replaces the default configuration
-# as all currently registered configuration handlers are removed by setting the registration mode to RegistrationMode_ReplaceAll.
-cam.RegisterConfiguration(pylon.SoftwareTriggerConfiguration(), pylon.RegistrationMode_ReplaceAll,
-                          pylon.Cleanup_Delete)
-
-cam.Open()
-print("Using device ", cam.GetDeviceInfo().GetModelName())
-
-
-# Set the Exposure Auto auto function to its minimum lower limit
-# and its maximum upper limit
-#minLowerLimit = cam.AutoExposureTimeLowerLimitRaw.Min
-#maxUpperLimit = cam.AutoExposureTimeUpperLimitRaw.Max
-#cam.AutoExposureTimeLowerLimitRaw.Value = minLowerLimit
-#cam.AutoExposureTimeUpperLimitRaw.Value = maxUpperLimit
-# Set the target brightness value to 128
-#cam.AutoTargetValue.Value = 128
-# Select auto function ROI 1
-#cam.AutoFunctionAOISelector.Value = "AOI1"
-# Enable the 'Intensity' auto function (Gain Auto + Exposure Auto)
-# for the auto function ROI selected
-#cam.AutoFunctionAOIUsageIntensity.Value = True
-# Enable Exposure Auto by setting the operating mode to Continuous
-#cam.ExposureAuto.Value = "Continuous"
-
-
-# Or better set everything to constant for pano stitching
-cam.ExposureAuto.SetValue("Off")
-cam.ExposureMode.SetValue("Timed")
-cam.ExposureTimeAbs.SetValue(50000)
-
-cam.GainAuto.SetValue("Off")
-cam.GainRaw.SetValue(300)
-
-
-
-
-cam.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
-
-
-converter = pylon.ImageFormatConverter()
-
-# converting to opencv bgr format
-converter.OutputPixelFormat = pylon.PixelType_BGR8packed
-converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
+autofocus_strategy = "golden_section" # "linear", "coarse_to_fine", "golden_section", "hill_climb" or "continuous" (one z move, camera free-runs)
+autofocus_backlash = 0 # Upward moves overshoot by this many steps and come back down, so every sample is approached from above
+autofocus_peak_fit = "gaussian" # Interpolate the best z between samples: "parabolic", "gaussian" or None
+use_focus_map = True # Predict z from earlier tiles and only verify it, full autofocus when the check fails
+focus_metric = "laplacian_variance" # "laplacian_variance", "tenengrad", "brenner" or "normalized_variance"
+focus_downscale = 0.5 # Autofocus scores a grayscale frame downscaled by this factor
+focus_roi = 0.5 # Centred fraction of the frame, (x, y, width, height) in pixels or None for the whole frame
+focus_camera_frames = True # Autofocus frames read out only focus_roi, binned by 1/focus_downscale, when switching pays off
+settle_threshold = 0.25 # After a move the stage counts as settled once frames shift less than this (pixels across a 256 px copy)
+settle_table = None # settle_table.json of an earlier scan: sleep its calibrated times instead of watching frames
+save_workers = 2 # Encoder threads, the scan only waits for them when the queue is full
+save_queue_depth = 8 # Frames waiting to be encoded before the scan blocks
+frame_buffers = save_queue_depth + save_workers + 4 # Preallocated camera buffers, frames wait in the save queue without a copy
+tile_format = "png" # "png", "tiff" (uncompressed, fast), "npy" (raw array) or "scan" (all tiles in one chunked file)
+png_compression = 1 # 0 (fastest, largest) to 9 (slowest, smallest)
+raw_capture = False # Save the sensor's Bayer/mono tiles (a third of the bytes), demosaic_tiles.py converts them afterwards
+camera_backend = "pylon" # "pylon" (Basler camera, Pico W stage) or "synthetic" (simulated camera and stage, no hardware)
+preview_fps = 10 # Live preview rate cap, shown on its own thread; 0 disables the preview
+preview_scale = 0.25 # Preview downscale factor
+
+preview = Preview(preview_fps, preview_scale) if preview_fps > 0 else None
+if camera_backend == "synthetic":
+    x_stage, y_stage, z_stage = SimulatedStage("x"), SimulatedStage("y"), SimulatedStage("z")
+    cam = SyntheticCamera(z_stage, x_stage, y_stage, tilt=(0.2, -0.1), preview=preview, buffers=frame_buffers,
+                          pixel_format="BayerRG8" if raw_capture else "BGR8")
+else:
+    x_stage = StageAxis("http://192.168.1.70/x_move")
+    y_stage = StageAxis("http://192.168.1.70/y_move")
+    z_stage = StageAxis("http://192.168.1.70/z_move")
+    cam = PylonCamera(exposure_us=50000, gain_raw=300, preview=preview, buffers=frame_buffers, raw=raw_capture)
 
 
 timestr = time.strftime("%Y%m%d-%H%M%S")
@@ -90,112 +73,120 @@ if not os.path.exists(timestr):
 x_dir = -1 # For snake-like back n forth movement
 x_coord = 0 # At what step we are for file naming
 
-def variance_of_laplacian(image):
-    image_filtered = cv2.medianBlur(image, 1)
-    return cv2.Laplacian(image_filtered, cv2.CV_64F).var()
-    
-
-def autofocus(camera, z_axis_url_base, autofocus_range, autofocus_step_size):
-    print("Starting autofocus...")
-    best_focus_score = -1
-    best_z_pos = 0
-
-    # Store (focus_score, z_position) pairs
-    focus_scores_and_positions = []
-
-    # Move to the start of the sweep
-    url = f"{z_axis_url_base}?steps={int(autofocus_range/2)}&dir=pos"
-    urllib.request.urlopen(url).read()
-
-    # Sweep through the autofocus range
-    for z_move in range(int(autofocus_range/autofocus_step_size)):
-        url = f"{z_axis_url_base}?steps={autofocus_step_size}&dir=neg"
-        with urllib.request.urlopen(url) as response:
-            html_content = response.read().decode('utf-8')
-        
-        # Extract current pos
-        start_tag = '<span id="z_pos">'
-        end_tag = '</span>'
-        start_index = html_content.find(start_tag)
-        end_index = html_content.find(end_tag, start_index)
-        value_str = html_content[start_index + len(start_tag):end_index]
-        current_z_pos = int(value_str)
-
-        # Capture an image
-        if camera.WaitForFrameTriggerReady(1000, pylon.TimeoutHandling_ThrowException):
-            camera.ExecuteSoftwareTrigger()
-            time.sleep(1) # Small delay for camera to capture
-            with camera.RetrieveResult(0, pylon.TimeoutHandling_Return) as result:
-                imageWindow.SetImage(result)
-                imageWindow.Show()
-                if result.GrabSucceeded():
-                    # Convert Pylon image to OpenCV format
-                    image = converter.Convert(result)
-                    img_np = image.GetArray()
-
-                    # Calculate focus score
-                    focus_score = variance_of_laplacian(img_np)
-                    focus_scores_and_positions.append((focus_score, current_z_pos))
-                    print(f"Z-pos: {current_z_pos}, Focus Score: {focus_score}")
-
-                    if focus_score > best_focus_score:
-                        best_focus_score = focus_score
-                        best_z_pos = current_z_pos
-
-    print(f"Autofocus complete. Best focus score: {best_focus_score} at Z-pos: {best_z_pos}")
+focus_score = FocusMetric(focus_metric, focus_downscale, focus_roi, cam.pixel_format)
+# Captures and scores autofocus frames, reduced frames while focusing a tile
+focus_frames = FocusFrames(cam, focus_score, focus_camera_frames)
+# Waits out the vibration after every stage move
+if settle_table is not None:
+    settle = SettleTable.load(settle_table)
+else:
+    settle = SettleDetector(settle_threshold, pixel_format=cam.pixel_format, log_path=timestr+"/settle_times.csv")
 
-    # Move to the best focus position
-    final_move_steps = best_z_pos - current_z_pos
-
-    if final_move_steps > 0:
-        url = f"{z_axis_url_base}?steps={abs(final_move_steps)}&dir=pos"
-    elif final_move_steps < 0:
-        url = f"{z_axis_url_base}?steps={abs(final_move_steps)}&dir=neg"
-    else:
-        print("Already at optimal focus position.")
-        return best_z_pos
-
-    try:
-        urllib.request.urlopen(url).read()
-        time.sleep(0.5)
-        print(f"Moved Z-axis to optimal position: {best_z_pos}")
-    except Exception as e:
-        print(f"Error moving Z-axis to optimal position: {e}")
-    
-    return best_z_pos
 
+def focus_probe(camera, z_stage):
+    # Every autofocus capture waits until the z move has settled
+    return FocusProbe(z_stage, focus_frames.score, autofocus_backlash,
+                      lambda steps: settle.wait(camera, "z", steps))
 
-def snap(cam, y, x):
+def autofocus(camera, z_stage, search, center=None):
+    print(f"Starting autofocus ({search.name})...")
+    if center is None:
+        center = z_stage.read_position()
 
-    if cam.WaitForFrameTriggerReady(1000, pylon.TimeoutHandling_ThrowException):
-        cam.ExecuteSoftwareTrigger()
-        time.sleep(0.2)
-        if cam.GetGrabResultWaitObject().Wait(0):
-            with cam.RetrieveResult(0, pylon.TimeoutHandling_Return) as result:
+    probe = focus_probe(camera, z_stage)
+    search.run(probe, center)
+    best_sample_z, best_focus_score = probe.best()
+    # Sub-step focus from the shape of the score curve around the best sample
+    best_z_pos = int(round(fit_peak(probe.samples, autofocus_peak_fit)))
 
-                # Grab and show image
-                imageWindow.SetImage(result)
-                imageWindow.Show()
+    print(f"Autofocus complete. Best focus score: {best_focus_score} at Z-pos: {best_sample_z}, fitted peak at {best_z_pos}")
 
-                # Calling AttachGrabResultBuffer creates another reference to the
-                # grab result buffer. This prevents the buffer's reuse for grabbing.
-                img.AttachGrabResultBuffer(result)
+    # Move to the best focus position
+    if z_stage.position == best_z_pos:
+        print("Already at optimal focus position.")
+    else:
+        try:
+            steps = best_z_pos - z_stage.position
+            probe.move_to(best_z_pos)
+            settle.wait(camera, "z", steps)
+            print(f"Moved Z-axis to optimal position: {best_z_pos}")
+        except Exception as e:
+            print(f"Error moving Z-axis to optimal position: {e}")
+
+    stats = probe.stats(search)
+    stats["fitted_z"] = best_z_pos
+    print(f"Autofocus used {stats['moves']} moves, {stats['captures']} captures, {stats['seconds']} s")
+    log_search(timestr+"/autofocus_stats.csv", stats)
+
+    return best_z_pos, best_focus_score
+
+def focus_tile(camera, z_stage, stage_x, stage_y, center=None):
+    # Full frames again for the capture that follows
+    with focus_frames:
+        return _focus_tile(camera, z_stage, stage_x, stage_y, center)
+
+def _focus_tile(camera, z_stage, stage_x, stage_y, center=None):
+    # Focus from the focus map when it can be trusted, full autofocus otherwise
+    if focus_map is not None and len(focus_map) > 0:
+        predicted = focus_map.predict(stage_x, stage_y)
+        print(f"Focus map predicts Z-pos {predicted:.1f}, verifying...")
+        probe = focus_probe(camera, z_stage)
+        verified_z, score = focus_map.verify(probe, predicted)
+        verified_z = int(round(verified_z))
+        if focus_map.accept(stage_x, stage_y, verified_z, score, predicted):
+            steps = verified_z - z_stage.position
+            probe.move_to(verified_z)
+            settle.wait(camera, "z", steps)
+            print(f"Focus map accepted, Z-pos {verified_z} after {probe.captures} captures")
+            return verified_z
+        center = verified_z
+
+    best_z_pos, best_focus_score = autofocus(camera, z_stage, autofocus_search, center)
+    if focus_map is not None:
+        focus_map.add(stage_x, stage_y, best_z_pos, best_focus_score)
+    return best_z_pos
 
-                filename = timestr+"/y"+str(y)+"_x"+str(x)+".png"
-                img.Save(pylon.ImageFileFormat_Png, filename)
-                img.Release()
 
+def snap(cam, y, x):
 
-current_z_position_steps = 0
+    # A ring buffer frame, PNG encoding happens on the pipeline
+    frame = cam.grab_frame()
+    if frame is None:
+        print(f"No image saved for y{y}_x{x}")
+        return
+    meta = {"z": z_stage.position, "pixel_format": cam.pixel_format}
+    if scan_store is not None:
+        # A copy into the page cache, nothing to encode
+        with frame:
+            scan_store.write(y, x, frame.array, meta)
+        return
+    filename = timestr+"/y"+str(y)+"_x"+str(x)+"."+tile_format
+    # The buffer goes back to the ring once the encoder has written it
+    save_pipeline.submit(frame.array, filename, copy=False, release=frame.release, meta=meta)
+
+
+save_pipeline = SavePipeline(save_workers, save_queue_depth, png_compression)
+scan_store = ScanStore(timestr+"/scan", y_step_count, x_step_count) if tile_format == "scan" else None
+if autofocus_strategy == "continuous":
+    # Needs the Basler camera and the stage firmware that reports move timing
+    from continuous_sweep import ContinuousSweep
+    autofocus_search = ContinuousSweep(autofocus_range, cam.camera, focus_frames.score_result,
+                                        tracker=cam.tracker)
+else:
+    autofocus_search = make_search(autofocus_strategy, autofocus_range, autofocus_step_size)
+focus_map = FocusMap(verify_step=autofocus_step_size//2, residual_threshold=autofocus_step_size//4) if use_focus_map else None
+
+# Every autofocus is centred on the previous tile's focus
+current_z_position_steps = None
 
 # Main loop with autofocus
 for y in range(y_step_count):
     print(f"\n--- Starting row {y}, performing autofocus ---")
-    current_z_position_steps = autofocus(
+    current_z_position_steps = focus_tile(
         cam,
-        "http://192.168.1.70/z_move",
-        autofocus_range,
-        autofocus_step_size
+        z_stage,
+        x_coord*x_step_size, y*y_step_size,
+        current_z_position_steps,
     )
     print(f"Autofocus completed for row {y}. Current Z-position: {current_z_position_steps}")
 
@@ -207,25 +198,34 @@ for y in range(y_step_count):
         x_coord = x_coord + x_dir
 
         # Advance in x in alternating directions
-        if x_dir == 1:
-            urllib.request.urlopen("http://192.168.1.70/x_move?steps="+str(x_step_size)+"&dir=pos").read()
-        else:
-            urllib.request.urlopen("http://192.168.1.70/x_move?steps="+str(x_step_size)+"&dir=neg").read()
+        x_stage.move(x_dir*x_step_size)
 
-        time.sleep(1)
-        current_z_position_steps = autofocus(
+        settle.wait(cam, "x", x_dir*x_step_size)
+        current_z_position_steps = focus_tile(
             cam,
-            "http://192.168.1.70/z_move",
-            autofocus_range,
-            autofocus_step_size
+            z_stage,
+            x_coord*x_step_size, y*y_step_size,
+            current_z_position_steps,
         )
         print(f"Autofocus completed for snap {x}. Current Z-position: {current_z_position_steps}")
         snap(cam, y, x_coord)
 
     # Advance in y
-    urllib.request.urlopen("http://192.168.1.70/y_move?steps="+str(y_step_size)+"&dir=neg").read()
+    y_stage.move(-y_step_size)
+    settle.wait(cam, "y", -y_step_size)
 
 
 # Cleanup
-cam.StopGrabbing()
-cam.Close()
+cam.report()
+settle.report()
+if settle_table is None:
+    settle.save(timestr+"/settle_table.json")
+focus_frames.report()
+save_pipeline.close()
+if scan_store is not None:
+    scan_store.close()
+if focus_map is not None:
+    print(f"Focus map: {focus_map.measured_tiles} tiles autofocused, {focus_map.predicted_tiles} from prediction")
+cam.close()
+if preview is not None:
+    preview.close()
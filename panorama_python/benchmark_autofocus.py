@@ -0,0 +1,64 @@
+import argparse
+import numpy as np
+
+from camera import SimulatedStage, SyntheticCamera
+from focus_metrics import FocusMetric
+from focus_search import FocusProbe, fit_peak, make_search, search_strategies
+
+
+# Compares the autofocus strategies on the synthetic camera: every run
+# starts from a position some distance away from a random focus and reports
+# captures, moves, wall time and how far the fitted focus ended up from the
+# true one. Stage and camera timings follow the hardware, so the seconds are
+# comparable to a real scan.
+#
+#   python benchmark_autofocus.py --runs 20 --latency 0.05
+
+def run_strategy(name, camera, stage, metric, search_range, step, true_focus, start, peak_fit, backlash=0):
+    stage.move_to(start)
+    camera.focus_z = true_focus
+    search = make_search(name, search_range, step)
+    probe = FocusProbe(stage, lambda: metric(camera.grab()), backlash)
+    search.run(probe, start)
+    fitted = fit_peak(probe.samples, peak_fit)
+    stats = probe.stats(search)
+    stats["error"] = abs(fitted - true_focus)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark autofocus strategies on the synthetic camera")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--range", type=int, default=200, help="autofocus_range in stage steps")
+    parser.add_argument("--step", type=int, default=20, help="autofocus_step_size in stage steps")
+    parser.add_argument("--offset", type=float, default=0.3, help="Largest start offset from focus, fraction of the range")
+    parser.add_argument("--peak-fit", default="gaussian")
+    parser.add_argument("--metric", default="laplacian_variance")
+    parser.add_argument("--width", type=int, default=648)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per capture on top of rendering")
+    parser.add_argument("--backlash", type=int, default=0, help="autofocus_backlash in stage steps")
+    parser.add_argument("--step-seconds", type=float, default=0.002, help="Stage time per step")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    stage = SimulatedStage("z", step_seconds=args.step_seconds)
+    camera = SyntheticCamera(stage, width=args.width, height=args.height, latency=args.latency, seed=args.seed)
+    metric = FocusMetric(args.metric)
+    rng = np.random.default_rng(args.seed)
+    focuses = rng.uniform(-1000, 1000, args.runs)
+    offsets = rng.uniform(-args.offset, args.offset, args.runs) * args.range
+
+    print(f"{args.runs} runs, range {args.range}, step {args.step}, frames {args.width}x{args.height}")
+    print(f"{'strategy':<16} {'captures':>9} {'moves':>6} {'seconds':>8} {'mean error':>11} {'max error':>10}")
+    for name in search_strategies:
+        runs = [run_strategy(name, camera, stage, metric, args.range, args.step, focus, int(focus + offset),
+                             args.peak_fit, args.backlash)
+                for focus, offset in zip(focuses, offsets)]
+        errors = [r["error"] for r in runs]
+        print(f"{name:<16} {np.mean([r['captures'] for r in runs]):>9.1f} {np.mean([r['moves'] for r in runs]):>6.1f} "
+              f"{np.mean([r['seconds'] for r in runs]):>8.2f} {np.mean(errors):>11.1f} {np.max(errors):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
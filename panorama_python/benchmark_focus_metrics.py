@@ -0,0 +1,93 @@
+import argparse
+import os
+import cv2
+import numpy as np
+
+from benchmark_fusion import load_stack, time_call
+from focus_metrics import focus_metrics, prepare
+from frame_store import FrameStore
+
+
+# Compares the focus metrics on z sweeps: runtime per frame at each downscale
+# and how clearly each curve singles out its peak. Sweeps are stack
+# directories as written by basler_pylon_stack.py (stack_N.png or a frame
+# store) or a synthetic sweep through a known focus position.
+#
+#   python benchmark_focus_metrics.py --sweep-dir captures/stack1 captures/stack2
+
+def synthetic_sweep(height, width, slices, seed=0):
+    # Whole frame in focus at the middle slice, blur growing either side
+    rng = np.random.default_rng(seed)
+    texture = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    texture = cv2.GaussianBlur(texture, (5, 5), 0)
+    focus = (slices - 1) / 2
+    frames = []
+    for k in range(slices):
+        sigma = 0.6 * abs(k - focus)
+        frame = cv2.GaussianBlur(texture, (0, 0), sigma) if sigma > 0 else texture.copy()
+        noise = rng.normal(0, 2, frame.shape)
+        frames.append(np.clip(frame + noise, 0, 255).astype(np.uint8))
+    return frames, list(range(slices))
+
+
+def load_sweep(sweep_dir):
+    if os.path.exists(os.path.join(sweep_dir, "stack.json")):
+        store = FrameStore.open(os.path.join(sweep_dir, "stack"))
+        return [store[k] for k in range(len(store))], list(store.z_positions)
+    frames = load_stack(sweep_dir)
+    return frames, list(range(len(frames)))
+
+
+def curve_quality(scores):
+    # Peak index, peak over the median of the curve and the number of slices
+    # above half the peak (above the curve minimum). A high ratio and a narrow
+    # peak make the autofocus search robust against noise.
+    scores = np.asarray(scores, dtype=np.float64)
+    peak = int(np.argmax(scores))
+    median = np.median(scores)
+    ratio = scores[peak] / median if median > 0 else float('inf')
+    half = scores.min() + (scores[peak] - scores.min()) / 2
+    width = int(np.sum(scores >= half))
+    return peak, ratio, width
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark autofocus metrics on z sweeps")
+    parser.add_argument("--sweep-dir", nargs="+", help="Stack directories, synthetic sweep if omitted")
+    parser.add_argument("--width", type=int, default=2592)
+    parser.add_argument("--height", type=int, default=2048)
+    parser.add_argument("--slices", type=int, default=11)
+    parser.add_argument("--downscales", type=float, nargs="+", default=[1.0, 0.5, 0.25, 0.125])
+    parser.add_argument("--roi", type=float, default=0.5, help="Centred fraction of the frame, 1 for the whole frame")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.sweep_dir:
+        sweeps = [(d,) + load_sweep(d) for d in args.sweep_dir]
+    else:
+        sweeps = [("synthetic",) + synthetic_sweep(args.height, args.width, args.slices)]
+    roi = None if args.roi >= 1 else args.roi
+
+    for name, frames, z_positions in sweeps:
+        height, width = frames[0].shape[:2]
+        print(f"\nSweep {name}: {len(frames)} frames of {width}x{height}")
+
+        # Reference: the old score, Laplacian variance of the full colour frame
+        reference = [cv2.Laplacian(f, cv2.CV_64F).var() for f in frames]
+        reference_peak = int(np.argmax(reference))
+        seconds, _ = time_call(lambda: cv2.Laplacian(frames[0], cv2.CV_64F).var(), repeat=args.repeat)
+        print(f"Reference (full frame, colour, float64): {seconds * 1000:.1f} ms per frame, peak at z {z_positions[reference_peak]}")
+
+        print(f"{'metric':<20} {'scale':>6} {'ms/frame':>9} {'peak z':>7} {'peak/median':>12} {'half width':>11}")
+        for metric_name, metric in focus_metrics.items():
+            for downscale in args.downscales:
+                score = lambda f: metric(prepare(f, downscale, roi))
+                seconds, _ = time_call(score, frames[0], repeat=args.repeat)
+                peak, ratio, half_width = curve_quality([score(f) for f in frames])
+                moved = "" if peak == reference_peak else " (peak differs from reference)"
+                print(f"{metric_name:<20} {downscale:>6} {seconds * 1000:>9.2f} {z_positions[peak]:>7} "
+                      f"{ratio:>12.2f} {half_width:>11d}{moved}")
+
+
+if __name__ == "__main__":
+    main()
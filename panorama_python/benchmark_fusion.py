@@ -0,0 +1,132 @@
+import argparse
+import glob
+import os
+import re
+import time
+import tracemalloc
+import cv2
+import numpy as np
+
+from itertools import product
+
+from focus_fusion import StreamingFuser, fuse_argmax, fuse_pyramid, sharpness_map
+
+
+# Compares the vectorized fusion engine against the per-pixel Python loop
+# that combine_exposures() used to run. The loop is far too slow for a full
+# frame, so it is timed on a crop and extrapolated per pixel.
+
+def synthetic_stack(height, width, slices, seed=0):
+    # Random texture on a tilted surface: every column band comes into focus
+    # at a different slice, so each slice contributes to the fused result
+    rng = np.random.default_rng(seed)
+    texture = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    texture = cv2.GaussianBlur(texture, (3, 3), 0)
+    focus_slice = np.linspace(0, slices - 1, width)[np.newaxis, :, np.newaxis]
+
+    images = []
+    for k in range(slices):
+        blurred = cv2.GaussianBlur(texture, (0, 0), 4)
+        weight = np.clip(np.abs(focus_slice - k) / 2.0, 0, 1)
+        frame = texture * (1 - weight) + blurred * weight
+        images.append(frame.astype(np.uint8))
+    return images
+
+
+def load_stack(stack_dir):
+    # stack_N.png as written by basler_pylon_stack.py, in slice order
+    files = glob.glob(os.path.join(stack_dir, "stack_*.png"))
+    files.sort(key=lambda f: int(re.findall(r"stack_(\d+)", f)[-1]))
+    return [cv2.imread(f) for f in files]
+
+
+def fuse_legacy_loop(images):
+    # The original combine_exposures() selection, with its index bookkeeping
+    # fixed so that the result is comparable to fuse_argmax()
+    laplacians = [sharpness_map(im) for im in images]
+    shape = images[0].shape
+    combined = np.zeros(shape, dtype=images[0].dtype)
+    for i, j in product(range(shape[0]), range(shape[1])):
+        max_index = -1
+        max_value = float('-inf')
+        for k, im in enumerate(images):
+            if laplacians[k][i, j] > max_value:
+                max_value = laplacians[k][i, j]
+                max_index = k
+
+        combined[i, j] = images[max_index][i, j]
+    return combined
+
+
+def fuse_streaming(images):
+    fuser = StreamingFuser()
+    for k, im in enumerate(images):
+        fuser.push(im, k)
+    return fuser.result()
+
+
+def time_call(fn, *args, repeat=1):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def peak_memory(fn, *args):
+    # Peak of NumPy allocations during the call, OpenCV internals not included
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark focus-stack fusion")
+    parser.add_argument("--stack-dir", help="Directory with stack_N.png files, synthetic stack if omitted")
+    parser.add_argument("--width", type=int, default=2592)
+    parser.add_argument("--height", type=int, default=2048)
+    parser.add_argument("--slices", type=int, default=10)
+    parser.add_argument("--loop-crop", type=int, default=128, help="Edge length of the crop timed with the Python loop")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tile-sizes", type=int, nargs="+", default=[256, 512, 1024], help="Tile edges tried in pyramid mode")
+    args = parser.parse_args()
+
+    if args.stack_dir:
+        images = load_stack(args.stack_dir)
+    else:
+        images = synthetic_stack(args.height, args.width, args.slices)
+    height, width = images[0].shape[:2]
+    pixels = height * width
+    print(f"Stack: {len(images)} slices of {width}x{height}")
+
+    crop = [im[:args.loop_crop, :args.loop_crop] for im in images]
+    crop_pixels = crop[0].shape[0] * crop[0].shape[1]
+
+    loop_time, loop_out = time_call(fuse_legacy_loop, crop)
+    loop_full = loop_time * pixels / crop_pixels
+    print(f"Python loop:  {loop_time:.3f} s on {crop_pixels} px crop, ~{loop_full:.1f} s extrapolated to full frame")
+
+    argmax_time, _ = time_call(fuse_argmax, images, repeat=args.repeat)
+    print(f"Vectorized:   {argmax_time:.3f} s full frame ({pixels / argmax_time / 1e6:.1f} MP/s)")
+    print(f"Speedup:      {loop_full / argmax_time:.0f}x")
+
+    streaming_time, _ = time_call(fuse_streaming, images, repeat=args.repeat)
+    print(f"Streaming:    {streaming_time:.3f} s full frame ({streaming_time / len(images) * 1000:.1f} ms per pushed slice)")
+
+    argmax_peak = peak_memory(fuse_argmax, images)
+    print(f"Argmax peak:  {argmax_peak / 2**20:.0f} MiB")
+    for tile_size in args.tile_sizes:
+        pyramid_time, _ = time_call(lambda ims: fuse_pyramid(ims, tile_size=tile_size), images, repeat=args.repeat)
+        pyramid_peak = peak_memory(lambda ims: fuse_pyramid(ims, tile_size=tile_size), images)
+        print(f"Pyramid {tile_size:4d}: {pyramid_time:.3f} s full frame, peak {pyramid_peak / 2**20:.0f} MiB")
+
+    # Both selection rules should pick the same pixels
+    agree = np.mean(np.all(loop_out == fuse_argmax(crop), axis=-1))
+    print(f"Agreement on crop: {agree * 100:.2f} %")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import cv2
+import numpy as np
+
+from tile_formats import ScanStore, read_tile, write_tile
+
+
+# Write and read throughput against disk usage for the tile formats, on a
+# real tile or a synthetic one of camera size. Files go to a temporary
+# directory on the same disk as --dir, so the numbers include the file system.
+#
+#   python benchmark_tile_formats.py --tile 20240101-120000/y0_x0.png
+
+def synthetic_tile(height, width, seed=0):
+    # Smooth structure with some fine detail and sensor noise, compresses
+    # roughly like a microscope image (random pixels would not compress at all)
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+    tile = cv2.resize(base, (width, height), interpolation=cv2.INTER_CUBIC)
+    detail = cv2.GaussianBlur(rng.integers(0, 64, (height, width, 3), dtype=np.uint8), (0, 0), 1.5)
+    noise = rng.normal(0, 2, tile.shape)
+    return np.clip(tile.astype(np.float32) * 0.75 + detail + noise, 0, 255).astype(np.uint8)
+
+
+def disk_usage(path):
+    # Allocated blocks, sparse files only count what was written
+    return os.stat(path).st_blocks * 512
+
+
+def bench_files(tile, directory, extension, count, png_level=1):
+    paths = [os.path.join(directory, f"tile_{k}.{extension}") for k in range(count)]
+    start = time.perf_counter()
+    for path in paths:
+        write_tile(path, tile, png_level)
+    write_seconds = (time.perf_counter() - start) / count
+
+    start = time.perf_counter()
+    for path in paths:
+        read_tile(path)
+    read_seconds = (time.perf_counter() - start) / count
+    size = sum(disk_usage(p) for p in paths) / count
+    assert np.array_equal(read_tile(paths[0]), tile), f"{extension} round trip changed the tile"
+    return write_seconds, read_seconds, size
+
+
+def bench_scan_store(tile, directory, count):
+    store = ScanStore(os.path.join(directory, "scan"), 1, count)
+    start = time.perf_counter()
+    for k in range(count):
+        store.write(0, k, tile)
+    store.close()
+    write_seconds = (time.perf_counter() - start) / count
+
+    store = ScanStore.open(os.path.join(directory, "scan"))
+    start = time.perf_counter()
+    for k in range(count):
+        np.array(store.read(0, k))  # Force the copy out of the page cache
+    read_seconds = (time.perf_counter() - start) / count
+    size = disk_usage(os.path.join(directory, "scan.raw")) / count
+    assert np.array_equal(store.read(0, 0), tile), "scan store round trip changed the tile"
+    return write_seconds, read_seconds, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tile output formats")
+    parser.add_argument("--tile", help="Image to write, synthetic tile if omitted")
+    parser.add_argument("--width", type=int, default=2592)
+    parser.add_argument("--height", type=int, default=2048)
+    parser.add_argument("--count", type=int, default=5, help="Tiles written per format")
+    parser.add_argument("--png-levels", type=int, nargs="+", default=[0, 1, 3, 6, 9])
+    parser.add_argument("--dir", default=".", help="Disk to benchmark on")
+    args = parser.parse_args()
+
+    tile = cv2.imread(args.tile) if args.tile else synthetic_tile(args.height, args.width)
+    megabytes = tile.nbytes / 2**20
+    print(f"Tile: {tile.shape[1]}x{tile.shape[0]}, {megabytes:.1f} MiB raw, {args.count} tiles per format")
+    print(f"{'format':<12} {'write ms':>9} {'write MiB/s':>12} {'read ms':>8} {'size MiB':>9} {'ratio':>6}")
+
+    directory = tempfile.mkdtemp(dir=args.dir)
+    try:
+        runs = [(f"png {level}", lambda d, level=level: bench_files(tile, d, "png", args.count, level))
+                for level in args.png_levels]
+        runs += [
+            ("tiff", lambda d: bench_files(tile, d, "tiff", args.count)),
+            ("npy", lambda d: bench_files(tile, d, "npy", args.count)),
+            ("scan store", lambda d: bench_scan_store(tile, d, args.count)),
+        ]
+        for name, run in runs:
+            run_dir = tempfile.mkdtemp(dir=directory)
+            write_seconds, read_seconds, size = run(run_dir)
+            print(f"{name:<12} {write_seconds * 1000:>9.1f} {megabytes / write_seconds:>12.0f} "
+                  f"{read_seconds * 1000:>8.1f} {size / 2**20:>9.1f} {tile.nbytes / size:>6.2f}")
+            shutil.rmtree(run_dir)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+import math
+import time
+import cv2
+import numpy as np
+
+from demosaic import demosaic, is_bayer, mosaic, raw_formats
+from focus_metrics import roi_rect
+from frame_ring import FrameRing
+
+try:
+    from pypylon import pylon
+    from capture import BurstCapture, FrameTracker, TriggeredCapture, exposure_ms
+except ImportError:
+    # Synthetic backend only, e.g. on a CI box without the pylon SDK
+    pylon = None
+
+
+# Camera backends for the scan scripts. Both hand out BGR uint8 frames,
+# None for a missed frame, and pass every frame on to an optional
+# preview.Preview. grab_frame() returns a frame_ring.RingFrame that the
+# caller releases (use it in a with block), nothing is allocated per frame;
+# grab() returns an array of the caller's own. With raw capture, frames are
+# the sensor's 8-bit Bayer or mono data instead of BGR (demosaic.py) and
+# `pixel_format` says which.
+#
+# configure_frames(roi, binning) switches both to a smaller frame (a window
+# of the sensor, binned) for autofocus and back to full frame with no
+# arguments; focus_frames.FocusFrames decides when that pays off.
+#
+#   PylonCamera      the Basler camera, software-triggered with fixed
+#                    exposure and gain for panorama stitching; with
+#                    burst_buffers it grabs one by one and `burst` takes
+#                    z-stacks without dropping frames (capture.BurstCapture)
+#   SyntheticCamera  renders a texture blurred by the distance between a
+#                    SimulatedStage's z and a simulated focus surface, with
+#                    noise and capture latency, so autofocus, fusion and the
+#                    scan loops can be benchmarked without hardware; the
+#                    exposure time scales brightness and clips like a sensor,
+#                    and the view rings down after every stage move
+
+class PylonCamera:
+
+    def __init__(self, exposure_us=50000, gain_raw=300, margin_ms=500, preview=None, buffers=8, burst_buffers=0,
+                 raw=False):
+        if pylon is None:
+            raise RuntimeError("pypylon is not installed, only the synthetic camera is available")
+        self.camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
+
+        # Register the standard configuration event handler for enabling software triggering.
+        # The software trigger configuration handler replaces the default configuration
+        # as all currently registered configuration handlers are removed by setting the registration mode to RegistrationMode_ReplaceAll.
+        self.camera.RegisterConfiguration(pylon.SoftwareTriggerConfiguration(), pylon.RegistrationMode_ReplaceAll,
+                                          pylon.Cleanup_Delete)
+        self.camera.Open()
+        print("Using device ", self.camera.GetDeviceInfo().GetModelName())
+
+        # Everything constant for pano stitching
+        self.camera.ExposureAuto.SetValue("Off")
+        self.camera.ExposureMode.SetValue("Timed")
+        self.camera.ExposureTimeAbs.SetValue(exposure_us)
+        self.exposure_us = exposure_us
+        self.camera.GainAuto.SetValue("Off")
+        self.camera.GainRaw.SetValue(gain_raw)
+
+        # Block IDs of every frame are followed, drops get reported
+        self.tracker = FrameTracker()
+        if burst_buffers:
+            # Frames are kept in order until retrieved, none is overwritten
+            self.camera.MaxNumBuffer.SetValue(burst_buffers)
+            self.strategy = pylon.GrabStrategy_OneByOne
+            self.burst = BurstCapture(self.camera, self.tracker, margin_ms)
+        else:
+            self.strategy = pylon.GrabStrategy_LatestImageOnly
+            self.burst = None
+        self.camera.StartGrabbing(self.strategy)
+
+        # converting to opencv bgr format. 8 bit formats are converted by
+        # OpenCV from the grab buffer straight into a ring buffer, anything
+        # else goes through pylon's converter, which allocates.
+        self.converter = pylon.ImageFormatConverter()
+        self.converter.OutputPixelFormat = pylon.PixelType_BGR8packed
+        self.converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
+        # OpenCV names Bayer patterns by the second row, pylon by the first
+        self.conversions = {
+            pylon.PixelType_Mono8: cv2.COLOR_GRAY2BGR,
+            pylon.PixelType_RGB8packed: cv2.COLOR_RGB2BGR,
+            pylon.PixelType_BayerRG8: cv2.COLOR_BayerBG2BGR,
+            pylon.PixelType_BayerBG8: cv2.COLOR_BayerRG2BGR,
+            pylon.PixelType_BayerGR8: cv2.COLOR_BayerGB2BGR,
+            pylon.PixelType_BayerGB8: cv2.COLOR_BayerGR2BGR,
+        }
+        self.ring = FrameRing(buffers)
+
+        # Raw frames are copied from the grab buffer as they are
+        self.raw = raw
+        self.pixel_format = "BGR8"
+        if raw:
+            self.pixel_format = self.camera.PixelFormat.GetValue()
+            if self.pixel_format not in raw_formats:
+                raise ValueError(f"Raw capture needs one of {raw_formats}, the camera sends {self.pixel_format}")
+        _show_raw(preview, self.pixel_format)
+
+        # Software-triggered frames with a timeout from the exposure time, no fixed sleeps
+        self.capture = TriggeredCapture(self.camera, margin_ms, self.tracker)
+        self.preview = preview
+
+    def frame_from(self, result):
+        # Converts a grab result into a ring buffer, the grab buffer can go
+        # back to the camera afterwards. The caller releases the frame.
+        shape = (result.GetHeight(), result.GetWidth())
+        frame = self.ring.acquire(shape if self.raw else shape + (3,))
+        try:
+            pixel_type = result.GetPixelType()
+            if self.raw or pixel_type == pylon.PixelType_BGR8packed:
+                with result.GetArrayZeroCopy() as raw:
+                    np.copyto(frame.array, raw)
+            elif pixel_type in self.conversions:
+                with result.GetArrayZeroCopy() as raw:
+                    cv2.cvtColor(raw, self.conversions[pixel_type], dst=frame.array)
+            else:
+                np.copyto(frame.array, self.converter.Convert(result).GetArray())
+        except Exception:
+            frame.release()
+            raise
+        return frame
+
+    def grab_frame(self):
+        result = self.capture.grab()
+        if result is None:
+            return None
+        with result:
+            frame = self.frame_from(result)
+        return self._publish(frame)
+
+    def burst_slices(self, wait=False):
+        # Frames of the current burst stack that have arrived, as (frame,
+        # slice index, commanded z); wait=True waits for the whole stack
+        arrivals = self.burst.finish() if wait else self.burst.arrived()
+        for result, index, z in arrivals:
+            with result:
+                frame = self.frame_from(result)
+            yield self._publish(frame), index, z
+
+    def _publish(self, frame):
+        if self.preview is not None:
+            self.preview.submit(frame.array, frame.retain().release)
+        return frame
+
+    def grab(self):
+        frame = self.grab_frame()
+        if frame is None:
+            return None
+        with frame:
+            return frame.array.copy()
+
+    def exposure_ms(self):
+        return exposure_ms(self.camera)
+
+    def set_exposure(self, exposure_us):
+        # Applies from the next trigger, exposure brackets switch per frame
+        self.camera.ExposureTimeAbs.SetValue(exposure_us)
+        self.exposure_us = exposure_us
+
+    def configure_frames(self, roi=None, binning=1):
+        # Sensor window (focus_metrics roi in full-resolution pixels, None
+        # for full frame) and binning for the following frames. Geometry
+        # can only change while not grabbing. Returns the binning applied,
+        # 1 on cameras without binning (colour models).
+        camera = self.camera
+        camera.StopGrabbing()
+        if camera.GetNodeMap().GetNode("BinningHorizontal") is None:
+            if binning != 1:
+                print("Camera has no binning, autofocus frames use the window only")
+            binning = 1
+        else:
+            binning = min(binning, camera.BinningHorizontal.GetMax())
+            camera.BinningHorizontal.SetValue(binning)
+            camera.BinningVertical.SetValue(binning)
+        # Offsets first, a window can only grow from offset 0
+        camera.OffsetX.SetValue(0)
+        camera.OffsetY.SetValue(0)
+        x, y, width, height = (v // binning for v in roi_rect(roi, camera.WidthMax.GetValue() * binning,
+                                                               camera.HeightMax.GetValue() * binning))
+        # Raw Bayer windows stay on whole 2x2 cells, so the pattern name stays right
+        cell = 2 if is_bayer(self.pixel_format) else 1
+        width -= width % max(camera.Width.GetInc(), cell)
+        height -= height % max(camera.Height.GetInc(), cell)
+        camera.Width.SetValue(width)
+        camera.Height.SetValue(height)
+        camera.OffsetX.SetValue(x - x % max(camera.OffsetX.GetInc(), cell))
+        camera.OffsetY.SetValue(y - y % max(camera.OffsetY.GetInc(), cell))
+        # Summing binning collects binning times the light per axis, the
+        # exposure is cut to match so scores and the preview keep their
+        # brightness. Averaging axes gain nothing.
+        gain = 1
+        for axis in ("Horizontal", "Vertical"):
+            mode = camera.GetNodeMap().GetNode(f"Binning{axis}Mode")
+            if mode is None or getattr(camera, f"Binning{axis}Mode").GetValue() == "Sum":
+                gain *= binning
+        exposure_us = self.exposure_us / gain
+        camera.ExposureTimeAbs.SetValue(max(exposure_us, camera.ExposureTimeAbs.GetMin()))
+        camera.StartGrabbing(self.strategy)
+        self.tracker.reset()
+        return binning
+
+    def report(self):
+        self.capture.report()
+        if self.burst is not None:
+            self.burst.report()
+        self.ring.report()
+
+    def close(self):
+        self.camera.StopGrabbing()
+        self.camera.Close()
+
+
+def _show_raw(preview, pixel_format):
+    # The preview demosaics raw frames on its own thread
+    if preview is not None and is_bayer(pixel_format):
+        preview.convert = lambda frame: demosaic(frame, pixel_format)
+
+
+class SimulatedStage:
+    # Same interface as stage.StageAxis. Moves take step_seconds per step
+    # plus the request latency, like the Pico W firmware.
+
+    def __init__(self, axis, position=0, step_seconds=0.002, request_seconds=0.01, limits=(-900000, 900000)):
+        self.axis = axis
+        self.position = position
+        self.moves = 0
+        self.last_move = None
+        self.step_seconds = step_seconds
+        self.request_seconds = request_seconds
+        self.limits = limits
+
+    def read_position(self):
+        time.sleep(self.request_seconds)
+        return self.position
+
+    def move(self, steps):
+        steps = int(steps)
+        if steps == 0:
+            return self.position
+        self.moves += 1
+        target = min(max(self.position + steps, self.limits[0]), self.limits[1])
+        start = time.perf_counter()
+        time.sleep(abs(target - self.position) * self.step_seconds)
+        self.last_move = {"start": start, "end": time.perf_counter(), "from": self.position, "to": target}
+        self.position = target
+        time.sleep(self.request_seconds)
+        return self.position
+
+    def move_to(self, target):
+        return self.move(int(target) - self.position)
+
+
+class SyntheticCamera:
+    # The focus surface is focus_z plus tilt (z steps per x and y step) plus
+    # relief z steps of slope across the frame, so a single frame is never
+    # sharp everywhere and focus stacks have something to fuse. Blur sigma
+    # in pixels is the distance to the surface divided by depth_of_field.
+
+    def __init__(self, z_stage, x_stage=None, y_stage=None, width=1296, height=1024, focus_z=0, tilt=(0.0, 0.0),
+                 relief=20, depth_of_field=15, noise=2.0, latency=0.05, pixels_per_step=10, seed=0, preview=None,
+                 buffers=8, exposure_us=50000, pixel_format="BGR8", reconfigure_seconds=0.1, vibration=8.0,
+                 settle_seconds=0.2):
+        self.z_stage = z_stage
+        self.x_stage = x_stage
+        self.y_stage = y_stage
+        self.width = width
+        self.height = height
+        self.focus_z = focus_z
+        self.tilt = tilt
+        self.relief = relief
+        self.depth_of_field = depth_of_field
+        self.noise = noise
+        self.latency = latency
+        self.pixels_per_step = pixels_per_step
+        self.base_exposure_us = exposure_us  # Exposure the texture is rendered at unscaled
+        self.exposure_us = exposure_us
+        self.preview = preview
+        self.ring = FrameRing(buffers)
+        self.pixel_format = pixel_format  # A raw format renders the frame the sensor would record
+        _show_raw(preview, pixel_format)
+        self.burst = None  # Rendering cannot drop frames
+        self.window = None  # Sensor window (x, y, width, height), None for full frame
+        self.binning = 1
+        self.reconfigure_seconds = reconfigure_seconds  # Stop, reconfigure and restart grabbing
+        self.vibration = vibration  # Pixels of shake right after a move of 20 steps or more
+        self.settle_seconds = settle_seconds  # Decay time of the shake
+        self.rng = np.random.default_rng(seed)
+        self.texture = self._texture(2 * height, 2 * width)
+        cv2.setRNGSeed(seed)
+        self.frames = 0
+
+    def _texture(self, height, width):
+        # Smooth blobs with fine detail on top; views wrap around the
+        # texture, so scans of any size find something to look at
+        base = self.rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+        texture = cv2.resize(base, (width, height), interpolation=cv2.INTER_CUBIC).astype(np.float32)
+        detail = self.rng.integers(0, 96, (height, width, 3), dtype=np.uint8)
+        return np.clip(texture * 0.6 + detail, 0, 255).astype(np.uint8)
+
+    def focus_at(self, x, y):
+        # Focus z at the centre of the frame for stage position x, y
+        return self.focus_z + self.tilt[0] * x + self.tilt[1] * y
+
+    def _shake(self, stage):
+        # Damped 6 Hz ring-down since the end of the stage's last move, in pixels
+        if stage is None or stage.last_move is None or not self.vibration:
+            return 0.0
+        t = time.perf_counter() - stage.last_move["end"]
+        amplitude = self.vibration * min(1.0, abs(stage.last_move["to"] - stage.last_move["from"]) / 20)
+        return amplitude * math.exp(-t / self.settle_seconds) * math.sin(2 * math.pi * 6 * t)
+
+    def _view(self, x, y):
+        top = round(y * self.pixels_per_step) % self.height
+        left = round(x * self.pixels_per_step) % self.width
+        return self.texture[top:top + self.height, left:left + self.width]
+
+    def render(self, x, y, z, window=None):
+        view = self._view(x, y)
+        columns = np.arange(self.width)
+        if window is not None:
+            left, top, width, height = window
+            view = view[top:top + height, left:left + width]
+            columns = columns[left:left + width]
+        # Blur per column from the distance to the focus surface, a tent
+        # blend of the nearest integer blur levels
+        surface = self.focus_at(x, y) + self.relief * (columns / self.width - 0.5)
+        sigma = np.abs(z - surface) / self.depth_of_field
+        frame = np.zeros(view.shape, dtype=np.float32)
+        for level in range(int(sigma.min()), int(np.ceil(sigma.max())) + 1):
+            weight = np.clip(1 - np.abs(sigma - level), 0, 1).astype(np.float32)
+            if not weight.any():
+                continue
+            blurred = view if level == 0 else cv2.GaussianBlur(view, (0, 0), level)
+            frame += blurred * weight[None, :, None]
+        if self.exposure_us != self.base_exposure_us:
+            frame *= self.exposure_us / self.base_exposure_us
+        noise = np.empty(frame.shape, dtype=np.float32)
+        cv2.randn(noise, 0, self.noise)  # Several times faster than NumPy's normal() at frame size
+        frame += noise
+        return np.clip(frame, 0, 255).astype(np.uint8)
+
+    def grab_frame(self):
+        # Rendering allocates, the ring only mirrors the camera's interface
+        time.sleep(self.latency)
+        x = self.x_stage.position if self.x_stage is not None else 0
+        y = self.y_stage.position if self.y_stage is not None else 0
+        x += self._shake(self.x_stage) / self.pixels_per_step
+        y += (self._shake(self.y_stage) + self._shake(self.z_stage)) / self.pixels_per_step
+        self.frames += 1
+        image = self.render(x, y, self.z_stage.position, self.window)
+        if self.binning != 1:
+            # Averaging, the exposure compensation of summed binning
+            image = cv2.resize(image, None, fx=1 / self.binning, fy=1 / self.binning, interpolation=cv2.INTER_AREA)
+        if self.pixel_format != "BGR8":
+            image = mosaic(image, self.pixel_format)
+        frame = self.ring.acquire(image.shape)
+        np.copyto(frame.array, image)
+        if self.preview is not None:
+            self.preview.submit(frame.array, frame.retain().release)
+        return frame
+
+    def grab(self):
+        with self.grab_frame() as frame:
+            return frame.array.copy()
+
+    def exposure_ms(self):
+        return self.latency * 1000
+
+    def set_exposure(self, exposure_us):
+        self.exposure_us = exposure_us
+
+    def configure_frames(self, roi=None, binning=1):
+        # Like PylonCamera; raw Bayer frames are not binned, as on colour models
+        time.sleep(self.reconfigure_seconds)
+        if is_bayer(self.pixel_format):
+            binning = 1
+        self.window = None if roi is None else roi_rect(roi, self.width, self.height)
+        if self.window is not None and is_bayer(self.pixel_format):
+            # Whole 2x2 cells, as the camera's increments keep them
+            self.window = tuple(v - v % 2 for v in self.window)
+        self.binning = binning
+        return binning
+
+    def report(self):
+        print(f"Rendered {self.frames} synthetic frames")
+        self.ring.report()
+
+    def close(self):
+        pass
@@ -0,0 +1,246 @@
+import csv
+import os
+import time
+
+from pypylon import pylon
+
+
+# Frame capture without fixed sleeps. RetrieveResult() waits on the grab
+# result wait object with a timeout derived from the exposure time, so a
+# capture returns as soon as the frame has arrived, and a frame that does
+# not arrive in time is reported and counted instead of silently dropped.
+# BurstCapture takes whole z-stacks without waiting for each frame.
+
+def exposure_ms(camera):
+    nodemap = camera.GetNodeMap()
+    name = "ExposureTimeAbs" if nodemap.GetNode("ExposureTimeAbs") is not None else "ExposureTime"
+    return getattr(camera, name).GetValue() / 1000
+
+
+def grab_timeout_ms(camera, margin_ms=500):
+    # Exposure plus a margin for readout and transfer
+    return int(exposure_ms(camera) + margin_ms)
+
+
+def drain(camera, tracker=None):
+    # Drops frames left over from an earlier late capture or a free-running
+    # sweep, so a grab never returns a frame exposed before its trigger
+    while camera.GetGrabResultWaitObject().Wait(0):
+        with camera.RetrieveResult(0, pylon.TimeoutHandling_Return) as result:
+            if tracker is not None and result.IsValid():
+                tracker.seen(result)
+
+
+class TriggeredCapture:
+    # One software-triggered frame per grab(). The returned grab result
+    # must be released, use it in a with block.
+
+    def __init__(self, camera, margin_ms=500, tracker=None):
+        self.camera = camera
+        self.margin_ms = margin_ms
+        self.tracker = tracker
+        self.frames = 0
+        self.missed = 0
+        self.wait_seconds = 0.0
+
+    def grab(self):
+        # None if the frame did not arrive in time or the grab failed
+        timeout_ms = grab_timeout_ms(self.camera, self.margin_ms)
+        drain(self.camera, self.tracker)
+        self.camera.WaitForFrameTriggerReady(timeout_ms, pylon.TimeoutHandling_ThrowException)
+        start = time.perf_counter()
+        self.camera.ExecuteSoftwareTrigger()
+        result = self.camera.RetrieveResult(timeout_ms, pylon.TimeoutHandling_Return)
+        self.wait_seconds += time.perf_counter() - start
+
+        if not result.IsValid():
+            self.missed += 1
+            print(f"Missed frame: nothing within {timeout_ms} ms of the trigger ({self.missed} missed so far)")
+            return None
+        if self.tracker is not None:
+            self.tracker.seen(result)
+        if not result.GrabSucceeded():
+            self.missed += 1
+            print(f"Missed frame: grab failed, {result.GetErrorDescription()} ({self.missed} missed so far)")
+            result.Release()
+            return None
+        self.frames += 1
+        return result
+
+    def report(self):
+        average = self.wait_seconds / (self.frames + self.missed) * 1000 if self.frames + self.missed else 0.0
+        print(f"Captured {self.frames} frames, {self.missed} missed, {average:.0f} ms from trigger to frame on average")
+
+
+def block_gap(previous, current):
+    # Frames missing between two block IDs, None for a repeated or older
+    # ID. GigE IDs are 16 bit and skip 0 when they wrap, USB3 IDs are 64 bit
+    # and never do; a wrap is taken as such if it skips less than half the range.
+    if current > previous:
+        return current - previous - 1
+    if previous <= 0xFFFF and current >= 1:
+        gap = 0xFFFF - previous + current - 1
+        if gap < 0x8000:
+            return gap
+    return None
+
+
+class FrameTracker:
+    # Follows the camera's block ID (frame counter) and timestamp over every
+    # grab result, so dropped and repeated frames show up anywhere.
+
+    def __init__(self):
+        self.last_id = None
+        self.last_timestamp = None
+        self.dropped = 0
+        self.repeated = 0
+
+    def reset(self):
+        # Grabbing restarted (frame geometry switched), counting starts over
+        self.last_id = None
+        self.last_timestamp = None
+
+    def seen(self, result):
+        block_id, timestamp = result.BlockID, result.TimeStamp
+        if self.last_id is not None:
+            gap = block_gap(self.last_id, block_id)
+            if gap is None or timestamp <= self.last_timestamp:
+                self.repeated += 1
+                print(f"Frame {block_id} repeated or out of order after frame {self.last_id}")
+                return
+            if gap:
+                self.dropped += gap
+                print(f"Camera dropped {gap} frames between frame {self.last_id} and {block_id}")
+        self.last_id, self.last_timestamp = block_id, timestamp
+
+
+class BurstCapture:
+    # Lossless z-stack acquisition, for a camera grabbing with
+    # GrabStrategy_OneByOne. trigger() fires a frame for the commanded z and
+    # returns as soon as the exposure is over (the camera is ready for the
+    # next trigger), so the stage moves on while the frame is still being
+    # transferred. Frames queue up in the grab buffers in order and are
+    # matched back to their trigger by block ID: a gap in the IDs is a
+    # dropped frame, and its z is known and reported instead of the stack
+    # silently ending up one slice short or with a slice twice.
+    #
+    # Matching counts IDs from the last frame the tracker saw before the
+    # stack, so every other grab on the camera has to go through the same
+    # tracker (TriggeredCapture and ContinuousSweep take it). Frames dropped
+    # at the end of a stack are skipped at the start of the next one. After
+    # grabbing restarted (tracker reset) one frame is taken to count from.
+
+    def __init__(self, camera, tracker, margin_ms=500, log_path=None):
+        self.camera = camera
+        self.tracker = tracker
+        self.margin_ms = margin_ms
+        self.log_path = log_path
+        self.label = None
+        self.commanded = []
+        self.received = {}
+        self.base_id = None
+        self.offset = 0  # Frames dropped after base_id, before this stack
+        self.end_id = None
+        self.trailing = 0
+        self.pending = 0
+        self.stacks = 0
+        self.dropped = 0
+
+    def start(self, label):
+        drain(self.camera, self.tracker)
+        if self.tracker.last_id is None:
+            self._seed()
+        self.label = label
+        self.commanded = []
+        self.received = {}
+        self.base_id = self.tracker.last_id
+        # Only if nothing else was grabbed since the last stack
+        self.offset = self.trailing if self.base_id is not None and self.base_id == self.end_id else 0
+        self.pending = 0
+
+    def _seed(self):
+        # Without a known last ID a dropped first slice could not be told
+        # from a received one
+        timeout_ms = grab_timeout_ms(self.camera, self.margin_ms)
+        self.camera.WaitForFrameTriggerReady(timeout_ms, pylon.TimeoutHandling_ThrowException)
+        self.camera.ExecuteSoftwareTrigger()
+        with self.camera.RetrieveResult(timeout_ms, pylon.TimeoutHandling_Return) as result:
+            if result.IsValid():
+                self.tracker.seen(result)
+        if self.tracker.last_id is None:
+            print("No frame to count block IDs from, a slice dropped at the start of the next stack goes unnoticed")
+
+    def trigger(self, z):
+        timeout_ms = grab_timeout_ms(self.camera, self.margin_ms)
+        self.camera.WaitForFrameTriggerReady(timeout_ms, pylon.TimeoutHandling_ThrowException)
+        self.camera.ExecuteSoftwareTrigger()
+        self.commanded.append(z)
+        self.pending += 1
+        # Ready again once the exposure has ended, the stage may move
+        self.camera.WaitForFrameTriggerReady(timeout_ms, pylon.TimeoutHandling_ThrowException)
+
+    def arrived(self, wait=False):
+        # Yields (result, slice index, commanded z) for frames that have
+        # arrived, each result must be released; wait=True waits for the
+        # rest of the stack. A frame that cannot be matched is released here.
+        while self.pending > 0:
+            timeout_ms = grab_timeout_ms(self.camera, self.margin_ms) if wait else 0
+            result = self.camera.RetrieveResult(timeout_ms, pylon.TimeoutHandling_Return)
+            if not result.IsValid():
+                return
+            index = self._match(result)
+            if index is None or not result.GrabSucceeded():
+                if index is not None:
+                    print(f"Slice {index} of {self.label} failed: {result.GetErrorDescription()}")
+                    del self.received[index]
+                result.Release()
+                continue
+            yield result, index, self.commanded[index]
+
+    def _match(self, result):
+        self.tracker.seen(result)
+        block_id = result.BlockID
+        # Only if _seed() got no frame either
+        if self.base_id is None:
+            self.base_id = block_id - 1
+        index = block_gap(self.base_id, block_id)
+        if index is not None:
+            index -= self.offset
+        if index is None or not 0 <= index < len(self.commanded) or index in self.received:
+            print(f"Frame {block_id} does not belong to a trigger of {self.label}, dropped")
+            return None
+        # Everything before this index that has not arrived never will
+        self.pending = len(self.commanded) - index - 1
+        self.received[index] = (block_id, result.TimeStamp)
+        return index
+
+    def finish(self):
+        # Waits for the remaining frames, then reports and logs the stack
+        yield from self.arrived(wait=True)
+        missing = [k for k in range(len(self.commanded)) if k not in self.received]
+        if self.received:
+            self.trailing = len(self.commanded) - 1 - max(self.received)
+        else:
+            self.trailing = self.offset + len(self.commanded)
+        self.end_id = self.tracker.last_id
+        self.stacks += 1
+        self.dropped += len(missing)
+        if missing:
+            print(f"Burst {self.label}: {len(missing)} of {len(self.commanded)} slices dropped, "
+                  f"z {[self.commanded[k] for k in missing]}")
+        if self.log_path is not None:
+            self._log()
+
+    def _log(self):
+        new_file = not os.path.exists(self.log_path)
+        with open(self.log_path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(["stack", "slice", "z", "block_id", "timestamp", "status"])
+            for k, z in enumerate(self.commanded):
+                block_id, timestamp = self.received.get(k, ("", ""))
+                writer.writerow([self.label, k, z, block_id, timestamp, "ok" if k in self.received else "dropped"])
+
+    def report(self):
+        print(f"Burst capture: {self.stacks} stacks, {self.dropped} slices dropped, "
+              f"camera dropped {self.tracker.dropped} frames, {self.tracker.repeated} repeated")
@@ -0,0 +1,107 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from pypylon import pylon
+
+from capture import exposure_ms
+
+
+# Continuous-motion autofocus sweep. Instead of move, wait, trigger, sleep
+# and grab per z step, the z axis travels the whole search range in one
+# command while the camera free-runs. Every frame is then paired with the z
+# the stage had at the middle of its exposure, interpolated between the
+# start and end of the move as reported by the stage firmware. Camera
+# timestamps are related to the host clock by latching the camera's
+# timestamp counter right before the sweep.
+#
+# The sweep takes as long as the z travel (about 2 ms per step with the
+# current firmware) and yields one sample per frame, so the exposure time
+# sets the sample spacing.
+
+class CameraClock:
+    # Maps camera frame timestamps onto time.perf_counter() seconds
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.host = None
+        self.ticks = None
+        self.frequency = None
+
+    def sync(self):
+        nodemap = self.camera.GetNodeMap()
+        before = time.perf_counter()
+        if nodemap.GetNode("TimestampLatch") is not None:
+            # USB3 and ace 2 cameras count nanoseconds
+            self.camera.TimestampLatch.Execute()
+            ticks = self.camera.TimestampLatchValue.GetValue()
+            frequency = 1e9
+        else:
+            self.camera.GevTimestampControlLatch.Execute()
+            ticks = self.camera.GevTimestampValue.GetValue()
+            frequency = self.camera.GevTimestampTickFrequency.GetValue()
+        after = time.perf_counter()
+        self.host, self.ticks, self.frequency = (before + after) / 2, ticks, frequency
+
+    def to_host(self, timestamp):
+        return self.host + (timestamp - self.ticks) / self.frequency
+
+
+def interpolate_z(move, t):
+    # Stage position at host time t during the move, None outside of it
+    if move["end"] <= move["start"] or not move["start"] <= t <= move["end"]:
+        return None
+    fraction = (t - move["start"]) / (move["end"] - move["start"])
+    return move["from"] + (move["to"] - move["from"]) * fraction
+
+
+class ContinuousSweep:
+    # Autofocus search strategy, used with a FocusProbe like the stepped
+    # ones in focus_search.py. score_frame(result) scores a grab result.
+    name = "continuous"
+
+    def __init__(self, search_range, camera, score_frame, timeout_ms=1000, tracker=None):
+        self.search_range = search_range
+        self.tracker = tracker  # capture.FrameTracker, keeps burst stacks in step
+        self.camera = camera
+        self.score_frame = score_frame
+        self.timeout_ms = timeout_ms
+        self.clock = CameraClock(camera)
+
+    def run(self, probe, center):
+        top = int(round(center + self.search_range / 2))
+        bottom = int(round(center - self.search_range / 2))
+        probe.move_to(top)
+        exposure = exposure_ms(self.camera) / 1000
+        self.clock.sync()
+
+        # The move blocks until the stage replies, so it runs on a thread
+        # while this one collects frames
+        frames = []
+        self.camera.TriggerMode.SetValue("Off")  # Free-run for the duration of the sweep
+        try:
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                mover = executor.submit(probe.stage.move_to, bottom)
+                while not mover.done():
+                    with self.camera.RetrieveResult(self.timeout_ms, pylon.TimeoutHandling_Return) as result:
+                        if result.IsValid() and self.tracker is not None:
+                            self.tracker.seen(result)
+                        if result.IsValid() and result.GrabSucceeded():
+                            middle = self.clock.to_host(result.TimeStamp) + exposure / 2
+                            frames.append((middle, self.score_frame(result)))
+                mover.result()  # Re-raises a failed move
+        finally:
+            self.camera.TriggerMode.SetValue("On")
+
+        move = probe.stage.last_move
+        if move is None:
+            raise RuntimeError("Stage firmware reports no move timing, continuous sweeps need it")
+        for t, score in frames:
+            z = interpolate_z(move, t)
+            if z is not None:
+                probe.samples[z] = score
+        probe.captures += len(frames)
+        print(f"Continuous sweep {top} -> {bottom}: {len(frames)} frames, "
+              f"{len(probe.samples)} inside the {move['end'] - move['start']:.2f} s move")
+        if not probe.samples:
+            raise RuntimeError("No frames during the continuous sweep")
+        return probe.best()[0]
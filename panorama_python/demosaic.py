@@ -0,0 +1,105 @@
+import cv2
+import numpy as np
+
+
+# Raw sensor frames. In raw capture mode the camera's native 8-bit format
+# (Bayer mosaic or mono) is kept as it comes off the sensor: a third of the
+# bytes of BGR to copy, queue and write, and no colour conversion while
+# scanning. Focus metrics look at one green site per 2x2 cell, a strided
+# view without a copy, and demosaicing happens later on the fusion workers
+# or in demosaic_tiles.py.
+#
+# Pixel formats are named as pylon's PixelFormat node reports them. OpenCV
+# names Bayer patterns by the second row, pylon by the first; the
+# edge-aware variants are used since demosaicing is off the scan path.
+
+bayer_codes = {
+    "BayerRG8": cv2.COLOR_BayerBG2BGR_EA,
+    "BayerBG8": cv2.COLOR_BayerRG2BGR_EA,
+    "BayerGR8": cv2.COLOR_BayerGB2BGR_EA,
+    "BayerGB8": cv2.COLOR_BayerGR2BGR_EA,
+}
+raw_formats = ("Mono8",) + tuple(bayer_codes)
+
+# Position of each colour in the 2x2 cell, (row, column)
+_bayer_sites = {
+    "BayerRG8": {"R": (0, 0), "G": (0, 1), "B": (1, 1)},
+    "BayerBG8": {"B": (0, 0), "G": (0, 1), "R": (1, 1)},
+    "BayerGR8": {"G": (0, 0), "R": (0, 1), "B": (1, 0)},
+    "BayerGB8": {"G": (0, 0), "B": (0, 1), "R": (1, 0)},
+}
+
+
+def is_bayer(pixel_format):
+    return pixel_format in bayer_codes
+
+
+def green_plane(raw, pixel_format):
+    # Half-resolution view of one green site per cell, mono frames as they are
+    if not is_bayer(pixel_format):
+        return raw
+    row, column = _bayer_sites[pixel_format]["G"]
+    return raw[row::2, column::2]
+
+
+def demosaic(raw, pixel_format):
+    # BGR for Bayer frames, mono frames are returned unchanged
+    if not is_bayer(pixel_format):
+        return raw
+    return cv2.cvtColor(raw, bayer_codes[pixel_format])
+
+
+def mosaic(bgr, pixel_format):
+    # The Bayer frame a sensor would have recorded, for the synthetic camera
+    if not is_bayer(pixel_format):
+        return cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+    raw = np.empty(bgr.shape[:2], dtype=bgr.dtype)
+    for colour, (row, column) in _bayer_sites[pixel_format].items():
+        channel = "BGR".index(colour)
+        raw[row::2, column::2] = bgr[row::2, column::2, channel]
+        if colour == "G":
+            raw[1 - row::2, 1 - column::2] = bgr[1 - row::2, 1 - column::2, channel]
+    return raw
+
+
+def warp_mosaic(raw, matrix, dst=None):
+    # Warps a Bayer frame without mixing colours: each of the four sites of
+    # the cell is warped as its own half-resolution plane. Full-resolution
+    # pixel x of a plane with offset d sits at plane pixel (x - d) / 2.
+    if dst is None:
+        dst = np.empty_like(raw)
+    height, width = raw.shape
+    for row in (0, 1):
+        for column in (0, 1):
+            to_full = np.array([[2, 0, column], [0, 2, row], [0, 0, 1]], dtype=np.float64)
+            to_plane = np.linalg.inv(to_full)
+            plane_matrix = (to_plane @ np.vstack([matrix, [0, 0, 1]]) @ to_full)[:2]
+            plane = np.ascontiguousarray(raw[row::2, column::2])
+            dst[row::2, column::2] = cv2.warpAffine(plane, plane_matrix, (plane.shape[1], plane.shape[0]),
+                                                    flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    return dst
+
+
+class DemosaicFuser:
+    # Wraps a fuser for stacks of raw frames: every frame is demosaiced
+    # before it goes to the wrapped fuser.
+
+    def __init__(self, fuser, pixel_format):
+        self.fuser = fuser
+        self.pixel_format = pixel_format
+
+    def __len__(self):
+        return len(self.fuser)
+
+    @property
+    def z_positions(self):
+        return self.fuser.z_positions
+
+    def push(self, frame, z=None):
+        self.fuser.push(demosaic(frame, self.pixel_format), z)
+
+    def result(self):
+        return self.fuser.result()
+
+    def height_map(self, refine=True):
+        return self.fuser.height_map(refine)
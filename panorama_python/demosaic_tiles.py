@@ -0,0 +1,85 @@
+import argparse
+import glob
+import json
+import os
+import re
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from demosaic import demosaic, raw_formats
+from tile_formats import ScanStore, read_tile, tile_formats, write_tile
+
+
+# Post-processing for scans taken with raw_capture: demosaics every raw tile
+# of a scan directory to BGR on a process pool, after the scan, so the scan
+# itself only moved and wrote the sensor's bytes. Reads the loose tiles
+# (y<row>_x<col>.npy/.tiff/.png) or a scan store. The pixel format comes
+# from the .npy sidecars or the scan store header, --pixel-format for
+# .tiff/.png tiles.
+#
+#   python demosaic_tiles.py 20240101-120000 --format tiff
+
+tile_name = re.compile(r"y(-?\d+)_x(-?\d+)\.(npy|tiff?|png)$")
+
+
+def _pixel_format(path, override):
+    if override is not None:
+        return override
+    sidecar = path.rsplit(".", 1)[0] + ".json"
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            return json.load(f).get("pixel_format", "BGR8")
+    raise ValueError(f"No pixel format for {path}, pass --pixel-format")
+
+
+def _demosaic_file(path, out_path, pixel_format, png_level):
+    write_tile(out_path, demosaic(read_tile(path), pixel_format), png_level)
+    return out_path
+
+
+def _demosaic_stored(store_path, y, x, out_path, pixel_format, png_level):
+    # Workers map the same scan store pages, tiles are not pickled
+    store = ScanStore.open(store_path)
+    write_tile(out_path, demosaic(store.read(y, x), pixel_format), png_level)
+    return out_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Demosaic the raw tiles of a scan")
+    parser.add_argument("scan_dir")
+    parser.add_argument("--out", help="Output directory, <scan_dir>/demosaiced if omitted")
+    parser.add_argument("--format", default="tiff", choices=tile_formats)
+    parser.add_argument("--png-level", type=int, default=1)
+    parser.add_argument("--pixel-format", choices=raw_formats, help="For tiles without a sidecar")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    out_dir = args.out or os.path.join(args.scan_dir, "demosaiced")
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = []
+        store_path = os.path.join(args.scan_dir, "scan")
+        if os.path.exists(store_path + ".json"):
+            store = ScanStore.open(store_path)
+            for key, meta in store.tiles.items():
+                y, x = (int(v) for v in key.split(","))
+                pixel_format = args.pixel_format or meta.get("pixel_format", "BGR8")
+                out_path = os.path.join(out_dir, f"y{y}_x{x}.{args.format}")
+                futures.append(executor.submit(_demosaic_stored, store_path, y, x, out_path, pixel_format,
+                                               args.png_level))
+        for path in sorted(glob.glob(os.path.join(args.scan_dir, "y*_x*.*"))):
+            match = tile_name.search(os.path.basename(path))
+            if match is None:
+                continue
+            out_path = os.path.join(out_dir, f"y{match[1]}_x{match[2]}.{args.format}")
+            futures.append(executor.submit(_demosaic_file, path, out_path, _pixel_format(path, args.pixel_format),
+                                           args.png_level))
+        for future in futures:
+            print(f"Wrote {future.result()}")
+    print(f"Demosaiced {len(futures)} tiles in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import time
+
+from focus_metrics import FocusMetric
+
+
+# Reduced frames for autofocus. Autofocus only needs a sharpness score of
+# the focus roi, so while a tile is being focused the camera reads out just
+# that window, binned by 1/downscale, instead of full frames that the metric
+# then crops and downscales: a fraction of the pixels to transfer, convert
+# and score. The capture after autofocus is full frame again.
+#
+# The metric sees the same pixels either way (the window is its roi,
+# binning does its downscale), so scores of both frame kinds stay
+# comparable, e.g. the focus map's reference scores.
+#
+# Switching stops and restarts grabbing, which costs about as much as a few
+# frames. The switch and the capture-and-score time of both frame kinds are
+# measured, and a sweep only switches when the captures a sweep takes on
+# average save more time than switching there and back costs.
+#
+#   with focus_frames:
+#       probe = FocusProbe(z_stage, focus_frames.score)
+
+class FocusFrames:
+
+    def __init__(self, camera, metric, enabled=True, calibration_frames=2):
+        self.camera = camera
+        self.full_metric = metric
+        self.focus_metric = metric
+        # Binning stands in for the whole-number part of the downscale
+        self.binning = max(1, int(round(1 / metric.downscale))) if enabled else 1
+        self.enabled = enabled and (metric.roi is not None or self.binning > 1)
+        self.calibration_frames = calibration_frames  # Full frames timed before the first switch
+        self.active = False
+        self.captures = 0  # Of the current sweep
+        self.sweeps = 0
+        self.sweep_captures = 0
+        self.focus_sweeps = 0
+        self.frame_seconds = {False: 0.0, True: 0.0}  # Capture and score time per frame kind
+        self.frames = {False: 0, True: 0}
+        self.switches = 0
+        self.switch_seconds = 0.0
+
+    @property
+    def metric(self):
+        return self.focus_metric if self.active else self.full_metric
+
+    def __enter__(self):
+        self.captures = 0
+        if self.enabled:
+            if not self.frames[False]:
+                for _ in range(self.calibration_frames):
+                    self.score()
+                self.captures = 0
+            if self._pays_off():
+                self._switch(True)
+        return self
+
+    def __exit__(self, *exc):
+        if self.active:
+            self._switch(False)
+        self.sweeps += 1
+        self.sweep_captures += self.captures
+
+    def _mean(self, focus):
+        return self.frame_seconds[focus] / self.frames[focus]
+
+    def _pays_off(self):
+        # Until both frame kinds and the switch are measured, it is assumed to
+        if not (self.frames[False] and self.frames[True] and self.switches and self.sweeps):
+            return True
+        saved = (self._mean(False) - self._mean(True)) * self.sweep_captures / self.sweeps
+        return saved > 2 * self.switch_seconds / self.switches
+
+    def _switch(self, focus):
+        start = time.perf_counter()
+        if focus:
+            binning = self.camera.configure_frames(self.full_metric.roi, self.binning)
+            # The camera did the roi and (part of) the downscale already
+            self.focus_metric = FocusMetric(self.full_metric.name, self.full_metric.downscale * binning, None,
+                                            self.full_metric.pixel_format)
+            self.focus_sweeps += 1
+        else:
+            self.camera.configure_frames()
+        self.switch_seconds += time.perf_counter() - start
+        self.switches += 1
+        self.active = focus
+
+    def score(self):
+        # Captures and scores one frame of the current kind, None for a missed frame
+        start = time.perf_counter()
+        frame = self.camera.grab_frame()
+        if frame is None:
+            return None
+        with frame:
+            score = self.metric(frame.array)
+        self.frame_seconds[self.active] += time.perf_counter() - start
+        self.frames[self.active] += 1
+        self.captures += 1
+        return score
+
+    def score_result(self, result):
+        # Continuous sweep frames come as grab results, converted into a ring buffer
+        with self.camera.frame_from(result) as frame:
+            self.captures += 1
+            return self.metric(frame.array)
+
+    def report(self):
+        if not self.enabled:
+            return
+        line = f"Autofocus frames: {self.focus_sweeps} of {self.sweeps} sweeps on reduced frames"
+        if self.frames[False] and self.frames[True]:
+            line += (f", {self._mean(False) * 1000:.0f} ms per full frame, {self._mean(True) * 1000:.0f} ms "
+                     f"per autofocus frame")
+        if self.switches:
+            line += f", {self.switch_seconds / self.switches * 1000:.0f} ms per switch"
+        print(line)
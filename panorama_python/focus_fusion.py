@@ -0,0 +1,322 @@
+import json
+import cv2
+import numpy as np
+
+from demosaic import DemosaicFuser, is_bayer
+from hdr import BracketFuser
+from tile_formats import write_tile
+
+
+# Focus-stack fusion shared by stacked_exposures.py and
+# focus_stacking_python/basler_pylon_stack.py.
+#
+# Every slice gets a per-pixel sharpness map (absolute Laplacian of the
+# grayscale frame, lightly blurred), the maps are stacked along z and the
+# output pixel is gathered from the slice with the highest response. All of
+# it runs as whole-array NumPy/OpenCV calls, no Python loop over pixels.
+
+laplacian_ksize = 3  # Aperture of the Laplacian used as sharpness measure
+sharpness_blur = 5   # Gaussian window smoothing the sharpness map, 0 disables
+
+pyramid_levels = 5          # Laplacian pyramid depth for the pyramid mode
+pyramid_tile_size = 512     # Tile edge in px, bounds the pyramid working memory
+pyramid_tile_overlap = 64   # Context around each tile, hides the tile seams
+
+fusion_modes = ("argmax", "pyramid")
+
+height_map_scale = 16  # Height map counts per stage step, 1/16 step resolution in 16 bit
+
+
+def sharpness_map(image, ksize=laplacian_ksize, blur=sharpness_blur):
+    if image.ndim == 3:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = image
+    lap = cv2.Laplacian(gray, cv2.CV_32F, ksize=ksize)
+    np.abs(lap, out=lap)
+    # Smoothing keeps single noisy pixels from winning the argmax on their own
+    if blur > 1:
+        lap = cv2.GaussianBlur(lap, (blur, blur), 0)
+    return lap
+
+
+def sharpness_stack(images, ksize=laplacian_ksize, blur=sharpness_blur):
+    first = sharpness_map(images[0], ksize, blur)
+    stack = np.empty((len(images),) + first.shape, dtype=np.float32)
+    stack[0] = first
+    for k in range(1, len(images)):
+        stack[k] = sharpness_map(images[k], ksize, blur)
+    return stack
+
+
+def focus_index(images, ksize=laplacian_ksize, blur=sharpness_blur):
+    # Index of the sharpest slice for every pixel
+    return np.argmax(sharpness_stack(images, ksize, blur), axis=0)
+
+
+def fuse_argmax(images, ksize=laplacian_ksize, blur=sharpness_blur):
+    frames = np.asarray(images)
+    best = focus_index(frames, ksize, blur)
+
+    # Gather the output pixels from the winning slices in one pass
+    index = best[np.newaxis, ..., np.newaxis] if frames.ndim == 4 else best[np.newaxis]
+    return np.take_along_axis(frames, index, axis=0)[0]
+
+
+class DepthTracker:
+    # Running per-pixel argmax over slice sharpness, which is the index of the
+    # in-focus slice and so the surface height. Besides the best sharpness it
+    # keeps the sharpness of the slices just before and after the winner,
+    # enough for a parabola fit between slices, and nothing else that grows
+    # with stack depth.
+
+    def __init__(self):
+        self.best = None
+        self.index = None
+        self.before = None
+        self.after = None
+        self.previous = None
+        self.z_positions = []
+
+    def __len__(self):
+        return len(self.z_positions)
+
+    def push(self, sharpness, z=None):
+        # Returns the mask of pixels this slice took over, None for the first
+        k = len(self.z_positions)
+        self.z_positions.append(k if z is None else z)
+
+        if self.best is None:
+            self.best = sharpness.copy()
+            self.index = np.zeros(sharpness.shape, dtype=np.uint16)
+            self.before = np.zeros_like(self.best)
+            self.after = np.zeros_like(self.best)
+            self.previous = sharpness
+            return None
+
+        # Slice k follows the current winner wherever that was slice k-1
+        np.copyto(self.after, sharpness, where=self.index == k - 1)
+
+        better = sharpness > self.best
+        np.copyto(self.before, self.previous, where=better)
+        np.copyto(self.best, sharpness, where=better)
+        self.index[better] = k
+        self.previous = sharpness
+        return better
+
+    def height_map(self, refine=True):
+        # Height in stage steps, optionally refined between slices by fitting
+        # a parabola through the winner and its two neighbours
+        z = np.asarray(self.z_positions, dtype=np.float32)
+        height = z[self.index]
+        if not refine or len(z) < 3:
+            return height
+
+        denom = self.before - 2 * self.best + self.after
+        inner = (self.index > 0) & (self.index < len(z) - 1) & (denom < 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            offset = 0.5 * (self.before - self.after) / denom
+        offset = np.where(inner, np.clip(offset, -0.5, 0.5), 0)
+
+        # Local slice spacing, the sweep does not have to be uniform
+        k = np.clip(self.index, 1, len(z) - 2)
+        step = (z[k + 1] - z[k - 1]) / 2
+        return height + offset * step
+
+
+def save_height_map(path, height, scale=height_map_scale):
+    # 16-bit PNG relative to the lowest z, the offset and scale go into a JSON
+    # sidecar so the map converts back to absolute stage steps
+    z_min = float(height.min())
+    counts = np.clip(np.rint((height - z_min) * scale), 0, 65535).astype(np.uint16)
+    cv2.imwrite(path, counts)
+    with open(path.rsplit(".", 1)[0] + ".json", "w") as f:
+        json.dump({"z_offset": z_min, "scale": scale, "units": "stage steps"}, f)
+
+
+class StreamingFuser:
+    # Incremental argmax fusion for frames arriving one at a time during the
+    # z sweep. Only the depth tracker maps and the fused output are kept, so
+    # memory and per-frame work stay the same no matter how deep the stack is.
+
+    def __init__(self, ksize=laplacian_ksize, blur=sharpness_blur):
+        self.ksize = ksize
+        self.blur = blur
+        self.depth = DepthTracker()
+        self.fused = None
+
+    def __len__(self):
+        return len(self.depth)
+
+    @property
+    def z_positions(self):
+        return self.depth.z_positions
+
+    def push(self, frame, z=None):
+        better = self.depth.push(sharpness_map(frame, self.ksize, self.blur), z)
+        if better is None:
+            self.fused = frame.copy()
+        else:
+            np.copyto(self.fused, frame, where=better[..., np.newaxis] if frame.ndim == 3 else better)
+
+    def result(self):
+        return self.fused
+
+    def height_map(self, refine=True):
+        return self.depth.height_map(refine)
+
+
+# Multi-scale mode: each slice is decomposed into a Laplacian pyramid, every
+# detail coefficient is taken from the slice with the most local energy at
+# that scale and the coarsest level is averaged. Picking per scale instead of
+# per pixel avoids the noisy seams of the argmax mode. The frame is handled in
+# overlapping tiles so the pyramids never exist for more than one tile.
+
+def tile_grid(height, width, tile_size=pyramid_tile_size, overlap=pyramid_tile_overlap):
+    # Yields (inner, padded) windows as (y0, y1, x0, x1); the padded window
+    # adds overlap context that is cropped away again after fusion
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            y1 = min(y0 + tile_size, height)
+            x1 = min(x0 + tile_size, width)
+            padded = (max(y0 - overlap, 0), min(y1 + overlap, height),
+                      max(x0 - overlap, 0), min(x1 + overlap, width))
+            yield (y0, y1, x0, x1), padded
+
+
+def laplacian_pyramid(image, levels):
+    current = image.astype(np.float32)
+    pyramid = []
+    for _ in range(levels):
+        down = cv2.pyrDown(current)
+        up = cv2.pyrUp(down, dstsize=(current.shape[1], current.shape[0]))
+        pyramid.append(current - up)
+        current = down
+    pyramid.append(current)
+    return pyramid
+
+
+def collapse_pyramid(pyramid):
+    current = pyramid[-1]
+    for detail in reversed(pyramid[:-1]):
+        current = cv2.pyrUp(current, dstsize=(detail.shape[1], detail.shape[0])) + detail
+    return current
+
+
+def _detail_energy(detail):
+    energy = np.abs(detail)
+    if energy.ndim == 3:
+        energy = energy.sum(axis=2)
+    return cv2.GaussianBlur(energy, (3, 3), 0)
+
+
+def fuse_pyramid_tile(tiles, levels=pyramid_levels):
+    # Small edge tiles cannot be reduced as often as full ones
+    levels = max(0, min(levels, int(np.log2(min(tiles[0].shape[:2]))) - 1))
+
+    fused = None
+    for tile in tiles:
+        pyramid = laplacian_pyramid(tile, levels)
+        energies = [_detail_energy(detail) for detail in pyramid[:-1]]
+        if fused is None:
+            fused = pyramid
+            best_energy = energies
+            continue
+
+        for level, energy in enumerate(energies):
+            better = energy > best_energy[level]
+            np.copyto(best_energy[level], energy, where=better)
+            if fused[level].ndim == 3:
+                better = better[..., np.newaxis]
+            np.copyto(fused[level], pyramid[level], where=better)
+        fused[-1] += pyramid[-1]
+
+    fused[-1] /= len(tiles)
+    return collapse_pyramid(fused)
+
+
+def fuse_pyramid(images, levels=pyramid_levels, tile_size=pyramid_tile_size, overlap=pyramid_tile_overlap):
+    # images can be any sequence of equally sized slices, only one tile of
+    # each is touched at a time
+    height, width = images[0].shape[:2]
+    dtype = images[0].dtype
+    limit = np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else None
+
+    fused = np.empty(images[0].shape, dtype=dtype)
+    for (y0, y1, x0, x1), (py0, py1, px0, px1) in tile_grid(height, width, tile_size, overlap):
+        tile = fuse_pyramid_tile([im[py0:py1, px0:px1] for im in images], levels)
+        tile = tile[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+        if limit is not None:
+            # Rounded, plain assignment would truncate towards zero
+            tile = np.clip(np.rint(tile), 0, limit)
+        fused[y0:y1, x0:x1] = tile
+    return fused
+
+
+class PyramidFuser:
+    # Same push/result interface as StreamingFuser. Pyramid selection needs
+    # every slice of a tile at once, so slices are held until result(). The
+    # depth tracker only runs when a height map is wanted.
+
+    def __init__(self, levels=pyramid_levels, tile_size=pyramid_tile_size, overlap=pyramid_tile_overlap, track_depth=False):
+        self.levels = levels
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.depth = DepthTracker() if track_depth else None
+        self.frames = []
+        self.z_positions = []
+
+    def __len__(self):
+        return len(self.z_positions)
+
+    def push(self, frame, z=None):
+        # Copied, frames can be camera or aligner buffers that get reused
+        self.frames.append(frame.copy())
+        self.z_positions.append(z)
+        if self.depth is not None:
+            self.depth.push(sharpness_map(frame), z)
+
+    def result(self):
+        if not self.frames:
+            return None
+        return fuse_pyramid(self.frames, self.levels, self.tile_size, self.overlap)
+
+    def height_map(self, refine=True):
+        if self.depth is None:
+            raise ValueError("PyramidFuser was created without track_depth")
+        return self.depth.height_map(refine)
+
+
+def make_fuser(mode="argmax", track_depth=False):
+    if mode == "argmax":
+        return StreamingFuser()
+    if mode == "pyramid":
+        return PyramidFuser(track_depth=track_depth)
+    raise ValueError(f"Unknown fusion mode '{mode}', expected one of {fusion_modes}")
+
+
+def stack_fuser(stack, mode="argmax", z_positions=None, track_depth=False, exposures=None, pixel_format=None):
+    # Runs an already captured stack (list, array or FrameStore memmap)
+    # through a fuser and returns the fuser. With exposures, the stack holds
+    # every slice as a row of brackets that are merged to HDR first; raw
+    # Bayer frames are demosaiced before anything else.
+    fuser = make_fuser(mode, track_depth)
+    if exposures is not None:
+        fuser = BracketFuser(fuser, exposures)
+    if is_bayer(pixel_format):
+        fuser = DemosaicFuser(fuser, pixel_format)
+    for k in range(len(stack)):
+        fuser.push(stack[k], k if z_positions is None else z_positions[k])
+    return fuser
+
+
+def fuse_stack(stack, mode="argmax", z_positions=None):
+    return stack_fuser(stack, mode, z_positions).result()
+
+
+def save_fused(fuser, out_path, height_map=False, refine=True, png_level=1):
+    # Fused tile in the format of its extension plus, on request, its height
+    # map as <name>_height.png
+    write_tile(out_path, fuser.result(), png_level)
+    if height_map:
+        save_height_map(out_path.rsplit(".", 1)[0] + "_height.png", fuser.height_map(refine))
@@ -0,0 +1,125 @@
+import numpy as np
+
+from focus_search import fit_peak
+
+
+# Predictive focus surface for panorama scans. Sample tilt and warp change
+# slowly across the scan, so the best z of a new tile is predicted from the
+# tiles measured so far: a plane while there are only a few of them, a
+# smoothing thin-plate spline once there are enough to follow warp. Tiles
+# then only get a short verification sweep around the prediction, and a full
+# autofocus runs only when that sweep disagrees with the model (sharpest at
+# either end of the sweep, or the fitted peak too far off) or the
+# sharpness drops well below what full autofocus runs achieved.
+
+class FocusMap:
+
+    def __init__(self, spline_points=12, smoothing=1.0, verify_step=10, verify_points=3,
+                 residual_threshold=5, sharpness_drop=0.7):
+        self.spline_points = spline_points  # Switch from plane to spline at this many points
+        self.smoothing = smoothing  # Spline regularisation, larger is stiffer
+        self.verify_step = verify_step  # Spacing of the verification sweep in z steps
+        self.verify_points = verify_points  # 1 only re-checks sharpness at the prediction
+        self.residual_threshold = residual_threshold  # Max |verified - predicted| in z steps
+        self.sharpness_drop = sharpness_drop  # Min fraction of the reference sharpness
+        # The fitted peak is clamped to the sweep, a threshold as wide as
+        # the sweep would never fire
+        span = verify_step * (verify_points // 2)
+        if verify_points >= 3 and residual_threshold >= span:
+            raise ValueError(f"residual_threshold {residual_threshold} must be smaller than the verify sweep "
+                             f"half-width {span}")
+        self.peak_at_edge = False  # Set by verify()
+        self.points = []
+        self.reference_scores = []
+        self.predicted_tiles = 0
+        self.measured_tiles = 0
+        self._model = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def add(self, x, y, z, score, measured=True):
+        self.points.append((x, y, z))
+        if measured:
+            # Only full autofocus runs define what "sharp" means
+            self.reference_scores.append(score)
+            self.measured_tiles += 1
+        else:
+            self.predicted_tiles += 1
+        self._model = None
+
+    def predict(self, x, y):
+        if not self.points:
+            return None
+        if self._model is None:
+            self._model = self._fit()
+        return float(self._model(x, y))
+
+    def _fit(self):
+        pts = np.array(self.points, dtype=np.float64)
+        xy, z = pts[:, :2], pts[:, 2]
+        if len(pts) < 3:
+            mean = z.mean()
+            return lambda x, y: mean
+
+        # Normalised coordinates keep both fits well conditioned
+        center = xy.mean(axis=0)
+        scale = xy.std(axis=0).max() or 1.0
+        uv = (xy - center) / scale
+        design = np.column_stack([np.ones(len(uv)), uv])
+
+        if len(pts) < self.spline_points:
+            # Least-squares plane; a single row of tiles just gets no tilt
+            # across rows (lstsq returns the minimum-norm solution)
+            coeffs, *_ = np.linalg.lstsq(design, z, rcond=None)
+            return lambda x, y: coeffs @ [1, (x - center[0]) / scale, (y - center[1]) / scale]
+
+        # Smoothing thin-plate spline: kernel r^2 log r plus an affine part
+        n = len(uv)
+        kernel = _tps_kernel(np.linalg.norm(uv[:, None] - uv[None], axis=2))
+        system = np.zeros((n + 3, n + 3))
+        system[:n, :n] = kernel + self.smoothing * np.eye(n)
+        system[:n, n:] = design
+        system[n:, :n] = design.T
+        solution = np.linalg.lstsq(system, np.concatenate([z, np.zeros(3)]), rcond=None)[0]
+        weights, affine = solution[:n], solution[n:]
+
+        def spline(x, y):
+            p = (np.array([x, y]) - center) / scale
+            return _tps_kernel(np.linalg.norm(uv - p, axis=1)) @ weights + affine @ [1, p[0], p[1]]
+        return spline
+
+    def verify(self, probe, predicted):
+        # Narrow sweep centred on the prediction, returns (z, score)
+        half = self.verify_points // 2
+        for k in range(-half, half + 1):
+            probe.measure(predicted + k * self.verify_step)
+        if self.verify_points < 3:
+            self.peak_at_edge = False
+            return predicted, probe.best()[1]
+        # Sharpest at the end of the sweep, the focus may lie outside of it
+        best_z = probe.best()[0]
+        self.peak_at_edge = best_z in (min(probe.samples), max(probe.samples))
+        return fit_peak(probe.samples, "gaussian"), probe.best()[1]
+
+    def accept(self, x, y, z, score, predicted):
+        # Keeps the verified z as a model point if it passes both thresholds
+        residual = z - predicted
+        reference = np.median(self.reference_scores) if self.reference_scores else None
+        if self.peak_at_edge:
+            print(f"Focus map verify peak at the edge of the sweep (Z-pos {z:.1f}), focus may lie outside of it")
+            return False
+        if abs(residual) > self.residual_threshold:
+            print(f"Focus map residual {residual:.1f} steps above threshold")
+            return False
+        if reference is not None and score < self.sharpness_drop * reference:
+            print(f"Focus score {score:.1f} dropped below {self.sharpness_drop:.0%} of reference {reference:.1f}")
+            return False
+        self.add(x, y, z, score, measured=False)
+        return True
+
+
+def _tps_kernel(r):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        k = r ** 2 * np.log(r)
+    return np.where(r > 0, k, 0.0)
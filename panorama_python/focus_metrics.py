@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+
+from demosaic import green_plane, is_bayer
+
+
+# Focus metrics for autofocus. The score only has to rank frames of one
+# sweep, so every metric runs on a grayscale, downscaled region of interest
+# instead of the full colour frame; the defocus blur that matters for the
+# ranking survives a 2x downscale well (benchmark_focus_metrics.py compares).
+#
+# roi is None for the whole frame, a fraction for a centred window of that
+# size (0.5 = the middle half in both directions) or (x, y, width, height)
+# in full-resolution pixels. The camera takes the same roi to read out
+# only that window for autofocus (focus_frames.py).
+#
+# Raw Bayer frames (pixel_format set) are scored on one green site per 2x2
+# cell, which is already a 2x downscale, so no colour conversion is needed.
+
+def roi_rect(roi, width, height):
+    # (x, y, width, height) of roi in a width x height frame
+    if roi is None:
+        return 0, 0, width, height
+    if isinstance(roi, (int, float)):
+        w, h = int(width * roi), int(height * roi)
+        return (width - w) // 2, (height - h) // 2, w, h
+    return tuple(roi)
+
+
+def prepare(image, downscale=0.5, roi=0.5):
+    if roi is not None:
+        x, y, w, h = roi_rect(roi, image.shape[1], image.shape[0])
+        image = image[y:y + h, x:x + w]
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    if downscale != 1:
+        gray = cv2.resize(gray, None, fx=downscale, fy=downscale, interpolation=cv2.INTER_AREA)
+    return gray.astype(np.float32)
+
+
+def laplacian_variance(gray):
+    return float(cv2.Laplacian(gray, cv2.CV_32F).var())
+
+
+def tenengrad(gray):
+    # Mean squared Sobel gradient magnitude
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1)
+    return float(np.mean(gx * gx + gy * gy))
+
+
+def brenner(gray):
+    # Squared difference of pixels two apart, horizontally and vertically
+    dx = gray[:, 2:] - gray[:, :-2]
+    dy = gray[2:, :] - gray[:-2, :]
+    return float(np.mean(dx * dx) + np.mean(dy * dy))
+
+
+def normalized_variance(gray):
+    # Intensity variance over mean, insensitive to exposure changes
+    mean = gray.mean()
+    return float(gray.var() / mean) if mean > 0 else 0.0
+
+
+focus_metrics = {
+    "laplacian_variance": laplacian_variance,
+    "tenengrad": tenengrad,
+    "brenner": brenner,
+    "normalized_variance": normalized_variance,
+}
+
+
+class FocusMetric:
+
+    def __init__(self, name="laplacian_variance", downscale=0.5, roi=0.5, pixel_format=None):
+        if name not in focus_metrics:
+            raise ValueError(f"Unknown focus metric '{name}', expected one of {tuple(focus_metrics)}")
+        self.name = name
+        self.downscale = downscale
+        self.roi = roi
+        self.pixel_format = pixel_format  # Raw frames from the camera, None for BGR
+        self.metric = focus_metrics[name]
+
+    def __call__(self, image):
+        if not is_bayer(self.pixel_format):
+            return self.metric(prepare(image, self.downscale, self.roi))
+        # Green plane coordinates are half the full-resolution ones
+        roi = self.roi if self.roi is None or isinstance(self.roi, (int, float)) else [v // 2 for v in self.roi]
+        return self.metric(prepare(green_plane(image, self.pixel_format), min(1.0, self.downscale * 2), roi))
@@ -0,0 +1,229 @@
+import csv
+import math
+import os
+import time
+import numpy as np
+
+
+# Autofocus search strategies. A strategy only decides which z positions to
+# look at; a FocusProbe moves the stage there, captures and scores a frame and
+# keeps count of moves, captures and time so strategies can be compared on
+# the same hardware.
+#
+# All strategies search a window of search_range steps centred on the start
+# position and return the best z they measured.
+
+class FocusProbe:
+
+    def __init__(self, stage, capture_score, backlash=0, settle=None):
+        # capture_score() grabs a frame at the current position and returns
+        # its focus score, or None if no frame came back
+        self.stage = stage
+        self.capture_score = capture_score
+        self.backlash = backlash  # Upward moves overshoot by this much and come back down
+        self.settle = settle  # settle(steps) waits out the vibration of a move before the capture
+        self.samples = {}
+        self.captures = 0
+        self.start_moves = stage.moves
+        self.start_time = time.perf_counter()
+
+    def move_to(self, z):
+        if self.backlash and self.stage.position is not None and z > self.stage.position:
+            # Always approach from above, like the original downward sweep
+            self.stage.move_to(z + self.backlash)
+        return self.stage.move_to(z)
+
+    def measure(self, z):
+        z = int(round(z))
+        if z in self.samples:
+            return self.samples[z]
+
+        # The stage clamps at its limits, use the position it reports
+        start = self.stage.position
+        reported = self.move_to(z)
+        if self.settle is not None and start is not None and reported != start:
+            self.settle(reported - start)
+        score = self.capture_score()
+        self.captures += 1
+        if score is None:
+            print(f"Z-pos: {reported}, no frame")
+            score = float('-inf')
+        else:
+            print(f"Z-pos: {reported}, Focus Score: {score}")
+        self.samples[z] = score
+        if reported != z:
+            self.samples[reported] = score
+        return score
+
+    def best(self):
+        return max(self.samples.items(), key=lambda item: item[1])
+
+    def stats(self, strategy):
+        best_z, best_score = self.best()
+        return {
+            "strategy": strategy.name,
+            "moves": self.stage.moves - self.start_moves,
+            "captures": self.captures,
+            "seconds": round(time.perf_counter() - self.start_time, 3),
+            "best_z": best_z,
+            "best_score": best_score,
+        }
+
+
+class LinearSweep:
+    # The original fixed sweep: step down through the window, capture at
+    # every step
+    name = "linear"
+
+    def __init__(self, search_range, step):
+        self.search_range = search_range
+        self.step = step
+
+    def run(self, probe, center):
+        top = center + self.search_range // 2
+        for k in range(int(self.search_range / self.step)):
+            probe.measure(top - (k + 1) * self.step)
+        return probe.best()[0]
+
+
+class CoarseToFine:
+    # A few widely spaced captures, then repeatedly probe either side of the
+    # best one at half the previous spacing down to fine_step; fit_peak
+    # interpolates below that
+    name = "coarse_to_fine"
+
+    def __init__(self, search_range, fine_step, coarse_points=5):
+        self.search_range = search_range
+        self.fine_step = fine_step
+        self.coarse_points = coarse_points
+
+    def run(self, probe, center):
+        spacing = self.search_range / (self.coarse_points - 1)
+        top = center + self.search_range / 2
+        for k in range(self.coarse_points):
+            probe.measure(top - k * spacing)
+
+        half = spacing / 2
+        while half >= self.fine_step:
+            best_z = probe.best()[0]
+            probe.measure(best_z + half)
+            probe.measure(best_z - half)
+            half /= 2
+        return probe.best()[0]
+
+
+class GoldenSection:
+    # Shrinks the window by the golden ratio per capture, assumes a single
+    # focus peak inside the window
+    name = "golden_section"
+
+    def __init__(self, search_range, tolerance):
+        self.search_range = search_range
+        self.tolerance = tolerance
+
+    def run(self, probe, center):
+        ratio = (math.sqrt(5) - 1) / 2
+        low = center - self.search_range / 2
+        high = center + self.search_range / 2
+        upper = low + ratio * (high - low)
+        lower = high - ratio * (high - low)
+        upper_score = probe.measure(upper)
+        lower_score = probe.measure(lower)
+
+        while high - low > self.tolerance:
+            if upper_score > lower_score:
+                low, lower, lower_score = lower, upper, upper_score
+                upper = low + ratio * (high - low)
+                upper_score = probe.measure(upper)
+            else:
+                high, upper, upper_score = upper, lower, lower_score
+                lower = high - ratio * (high - low)
+                lower_score = probe.measure(lower)
+        return probe.best()[0]
+
+
+class HillClimb:
+    # Climbs the score from the start position, halving the step after
+    # every overshoot; stops early once the step gets below min_step. Cheap
+    # when the previous tile's focus is already close.
+    name = "hill_climb"
+
+    def __init__(self, step, min_step, max_captures=20):
+        self.step = step
+        self.min_step = min_step
+        self.max_captures = max_captures
+
+    def run(self, probe, center):
+        best_z, best_score = center, probe.measure(center)
+        step = self.step
+        direction = -1
+        while step >= self.min_step and probe.captures < self.max_captures:
+            score = probe.measure(best_z + direction * step)
+            if score > best_score:
+                best_z, best_score = best_z + direction * step, score
+                continue
+            score = probe.measure(best_z - direction * step)
+            if score > best_score:
+                direction = -direction
+                best_z, best_score = best_z + direction * step, score
+                continue
+            step //= 2
+        return probe.best()[0]
+
+
+def fit_peak(samples, method="parabolic", top=3):
+    # Interpolated best z from the top scoring samples, so a coarse sweep
+    # still lands between its steps. "gaussian" fits the parabola to the log
+    # of the scores, which matches the shape of a focus curve better away
+    # from the peak. Falls back to the best sample if the fit is not a peak.
+    measured = [(z, score) for z, score in samples.items() if np.isfinite(score)]
+    if not measured:
+        raise ValueError("No focus samples to fit")
+    measured.sort(key=lambda item: item[1], reverse=True)
+    best_z = measured[0][0]
+    points = measured[:top]
+    zs = np.array([z for z, _ in points], dtype=np.float64)
+    if method is None or len(set(zs)) < 3:
+        return best_z
+
+    scores = np.array([score for _, score in points], dtype=np.float64)
+    if method == "gaussian":
+        if np.any(scores <= 0):
+            return best_z
+        scores = np.log(scores)
+    elif method != "parabolic":
+        raise ValueError(f"Unknown peak fit '{method}', expected 'parabolic' or 'gaussian'")
+
+    # Centred on the best sample to keep the fit well conditioned
+    a, b, _ = np.polyfit(zs - best_z, scores, 2)
+    if a >= 0:
+        return best_z
+    peak = best_z - b / (2 * a)
+    return float(np.clip(peak, zs.min(), zs.max()))
+
+
+search_strategies = ("linear", "coarse_to_fine", "golden_section", "hill_climb")
+
+
+def make_search(name, search_range, step):
+    # Strategies configured from the scan scripts' autofocus_range and
+    # autofocus_step_size
+    if name == "linear":
+        return LinearSweep(search_range, step)
+    if name == "coarse_to_fine":
+        return CoarseToFine(search_range, step)
+    if name == "golden_section":
+        return GoldenSection(search_range, step)
+    if name == "hill_climb":
+        return HillClimb(2 * step, step // 2 or 1)
+    raise ValueError(f"Unknown autofocus search '{name}', expected one of {search_strategies}")
+
+
+def log_search(path, stats):
+    # One CSV row per autofocus run
+    new_file = not os.path.exists(path)
+    with open(path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(stats))
+        if new_file:
+            writer.writeheader()
+        writer.writerow(stats)
@@ -0,0 +1,107 @@
+import threading
+import time
+import numpy as np
+
+
+# Preallocated frame buffers for the capture path. The camera converts each
+# grab result straight into a free slot of the ring and hands out a
+# RingFrame: a NumPy view of that slot plus a reference count. Whoever
+# keeps the frame beyond the call that received it (save queue, preview)
+# takes a reference with retain() and gives it back with release(); the
+# slot is reused once the count drops to zero. In steady state nothing is
+# allocated per frame.
+#
+# The buffers are allocated on the first frame, once the frame size is
+# known, as flat bytes per slot. Smaller frames (autofocus ROI or binning)
+# are views into the same slots, so switching frame geometry back and forth
+# allocates nothing; only a frame larger than the slots reallocates.
+# When every slot is still held the grab waits for one, like the save
+# queue does when it is full, and gives up with an error after
+# wait_timeout seconds: that is a consumer that never released its frame.
+
+class RingFrame:
+
+    def __init__(self, ring, index, array):
+        self.ring = ring
+        self.index = index
+        self.array = array
+        self.refs = 1
+
+    def retain(self):
+        with self.ring.lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        self.ring._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class FrameRing:
+
+    def __init__(self, slots=8, wait_timeout=10.0):
+        self.slots = slots
+        self.wait_timeout = wait_timeout
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.buffers = None
+        self.free = []
+        self.acquired = 0
+        self.allocations = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def _allocate(self, nbytes):
+        self.buffers = np.empty((self.slots, nbytes), dtype=np.uint8)
+        self.free = list(range(self.slots))
+        self.allocations += 1
+
+    def acquire(self, shape, dtype=np.uint8):
+        # A writable slot of the given shape, with one reference
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        with self.available:
+            if self.buffers is None:
+                self._allocate(nbytes)
+            elif self.buffers.shape[1] < nbytes:
+                self._wait_until(lambda: len(self.free) == self.slots, "every frame before reallocating")
+                self._allocate(nbytes)
+            if not self.free:
+                self._wait_until(lambda: self.free, "a free slot")
+            # Oldest released slot first, so a frame stays readable for as
+            # long as possible after its release
+            index = self.free.pop(0)
+            self.acquired += 1
+            array = self.buffers[index, :nbytes].view(dtype).reshape(shape)
+            return RingFrame(self, index, array)
+
+    def _wait_until(self, ready, what):
+        if ready():
+            return
+        start = time.perf_counter()
+        if not self.available.wait_for(ready, self.wait_timeout):
+            raise RuntimeError(f"Frame ring: waited {self.wait_timeout} s for {what}, "
+                               f"{self.slots - len(self.free)} of {self.slots} frames never released")
+        waited = time.perf_counter() - start
+        self.waits += 1
+        self.wait_seconds += waited
+        if waited > 0.01:
+            print(f"Frame ring: capture waited {waited:.2f} s for {what}")
+
+    def _release(self, frame):
+        with self.available:
+            if frame.refs <= 0:
+                raise RuntimeError(f"Frame ring: slot {frame.index} released more often than retained")
+            frame.refs -= 1
+            if frame.refs == 0:
+                self.free.append(frame.index)
+                self.available.notify_all()
+
+    def report(self):
+        print(f"Frame ring: {self.acquired} frames through {self.slots} buffers, "
+              f"{self.allocations} allocations, waited {self.waits} times ({self.wait_seconds:.1f} s)")
@@ -0,0 +1,86 @@
+import json
+import os
+import time
+import numpy as np
+
+from tile_formats import MemmapStore
+
+
+# Raw focus-stack storage. The slices of one tile go into a preallocated
+# np.memmap (<path>.raw) and a small JSON sidecar (<path>.json) records the
+# shape, dtype, z positions and capture timestamps. Writing a slice is a
+# plain memory copy, no PNG compression in the capture loop, and fusion or
+# inspection read slices straight from the page cache without a copy.
+#
+# The array is laid out slices x height x width x channels so that every
+# slice is one contiguous block on disk.
+
+class FrameStore(MemmapStore):
+    # Takes frames through push() like a fuser. The memmap is allocated on
+    # the first frame, once the frame shape is known.
+
+    def __init__(self, path, slices, pixel_format="BGR8"):
+        self.path = path
+        self.slices = slices
+        self.pixel_format = pixel_format  # Raw stores keep the sensor format (demosaic.py)
+        self.array = None
+        self.z_positions = []
+        self.timestamps = []
+
+    def __len__(self):
+        return len(self.z_positions)
+
+    def __getitem__(self, k):
+        if not -len(self) <= k < len(self):
+            raise IndexError(f"Slice {k} not in store of {len(self)} slices")
+        return self._slice_view(self.array[k % len(self)])
+
+    def _slice_view(self, frame):
+        # Mono stores keep a channel axis on disk but hand out 2-D slices
+        return frame[..., 0] if frame.shape[-1] == 1 else frame
+
+    @classmethod
+    def open(cls, path, mode="r"):
+        with open(path + ".json") as f:
+            header = json.load(f)
+        store = cls(path, header["shape"][0])
+        store.array = np.memmap(path + ".raw", dtype=header["dtype"], mode=mode, shape=tuple(header["shape"]))
+        store.z_positions = header["z_positions"]
+        store.timestamps = header["timestamps"]
+        store.pixel_format = header.get("pixel_format", "BGR8")
+        return store
+
+    def push(self, frame, z=None, timestamp=None):
+        if self.array is None:
+            height, width = frame.shape[:2]
+            channels = frame.shape[2] if frame.ndim == 3 else 1
+            self.array = np.memmap(self.path + ".raw", dtype=frame.dtype, mode="w+",
+                                   shape=(self.slices, height, width, channels))
+        if len(self) >= self.slices:
+            raise ValueError(f"Frame store {self.path} is full ({self.slices} slices)")
+
+        self.array[len(self)] = frame.reshape(self.array.shape[1:])
+        self.z_positions.append(z)
+        self.timestamps.append(time.time() if timestamp is None else timestamp)
+
+    def stack(self):
+        # Filled slices only, as a memmap view
+        stack = self.array[:len(self)]
+        return stack[..., 0] if stack.shape[-1] == 1 else stack
+
+    def header(self):
+        return {
+            "shape": list(self.array.shape),
+            "dtype": self.array.dtype.str,
+            "count": len(self),
+            "z_positions": self.z_positions,
+            "timestamps": self.timestamps,
+            "pixel_format": self.pixel_format,
+        }
+
+    def discard(self):
+        # Drops the stack without saving it, e.g. before it is captured again
+        self.array = None
+        for path in (self.path + ".raw", self.path + ".json"):
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,149 @@
+import multiprocessing
+import os
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from focus_fusion import save_fused, stack_fuser
+from frame_store import FrameStore
+
+
+# Background fusion on a process pool. The capture loop writes its slices
+# straight into a shared-memory stack; the worker attaches to the same block
+# by name, so frames never get pickled across the process boundary. The scan
+# can move on to the next XY position while earlier tiles are still fusing.
+# Exposure-bracketed stacks are merged to HDR and raw stacks demosaiced on
+# the worker as well.
+#
+# Workers are spawned, not forked, so they inherit neither the camera nor
+# the preview thread. Scripts using this must keep their camera setup and
+# scan loop under `if __name__ == "__main__":`, spawned workers re-import
+# the main module. A tile that fails to fuse is reported and the scan goes
+# on.
+
+class SharedStack:
+    # Collects a stack for a fusion worker. The shared block is allocated
+    # on the first frame, once the frame shape is known.
+
+    def __init__(self, slices, exposures=None, pixel_format="BGR8"):
+        self.slices = slices
+        self.exposures = exposures  # Bracket exposure times, every slice pushed once per exposure
+        self.pixel_format = pixel_format  # Raw stacks keep the sensor format (demosaic.py)
+        self.shm = None
+        self.array = None
+        self.z_positions = []
+
+    def __len__(self):
+        return len(self.z_positions)
+
+    def push(self, frame, z=None):
+        if self.shm is None:
+            shape = (self.slices,) + frame.shape
+            self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * frame.itemsize)
+            self.array = np.ndarray(shape, dtype=frame.dtype, buffer=self.shm.buf)
+        if len(self.z_positions) >= self.slices:
+            raise ValueError(f"Shared stack is full ({self.slices} slices)")
+
+        self.array[len(self.z_positions)] = frame
+        self.z_positions.append(z)
+
+    def release(self):
+        if self.shm is None:
+            return
+        # The view has to go before the block can be closed
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+
+def _fuse_to_file(stack, z_positions, mode, out_path, height_map, png_level, exposures, pixel_format):
+    fuser = stack_fuser(stack, mode, z_positions, track_depth=height_map, exposures=exposures,
+                        pixel_format=pixel_format)
+    save_fused(fuser, out_path, height_map, png_level=png_level)
+
+
+def _fuse_shared_stack(shm_name, shape, dtype, z_positions, mode, out_path, height_map, png_level, exposures,
+                       pixel_format):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        _fuse_to_file(np.ndarray(shape, dtype=dtype, buffer=shm.buf), z_positions, mode, out_path, height_map,
+                      png_level, exposures, pixel_format)
+    finally:
+        shm.close()
+    return out_path
+
+
+def _fuse_frame_store(store_path, mode, out_path, height_map, png_level, exposures):
+    store = FrameStore.open(store_path)
+    _fuse_to_file(store.stack(), store.z_positions, mode, out_path, height_map, png_level, exposures,
+                  store.pixel_format)
+    return out_path
+
+
+class FusionPool:
+
+    def __init__(self, workers=None, mode="argmax", max_pending=None, height_maps=False, png_level=1):
+        workers = workers or os.cpu_count()
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.mode = mode
+        self.height_maps = height_maps
+        self.png_level = png_level  # Only used for .png outputs
+        # Every pending tile holds a whole stack in shared memory, so the scan
+        # blocks once this many tiles are waiting to be fused
+        self.max_pending = max_pending or 2 * workers
+        self.pending = deque()  # (future, out_path)
+        self.failed = 0
+
+    def stack(self, slices, exposures=None, pixel_format="BGR8"):
+        # Room for every bracket of every slice
+        return SharedStack(slices * (len(exposures) if exposures else 1), exposures, pixel_format)
+
+    def submit(self, stack, out_path):
+        if len(stack) == 0:
+            stack.release()
+            return None
+
+        while len(self.pending) >= self.max_pending:
+            self._collect()
+
+        # Only the filled slices are handed to the worker
+        shape = (len(stack),) + stack.array.shape[1:]
+        future = self.executor.submit(_fuse_shared_stack, stack.shm.name, shape, stack.array.dtype.str,
+                                      list(stack.z_positions), self.mode, out_path, self.height_maps, self.png_level,
+                                      stack.exposures, stack.pixel_format)
+        future.add_done_callback(lambda f: stack.release())
+        self.pending.append((future, out_path))
+        return future
+
+    def submit_store(self, store_path, out_path, exposures=None):
+        # Frame stores are already shared through the file, the worker maps
+        # the same pages
+        while len(self.pending) >= self.max_pending:
+            self._collect()
+        future = self.executor.submit(_fuse_frame_store, store_path, self.mode, out_path, self.height_maps,
+                                      self.png_level, exposures)
+        self.pending.append((future, out_path))
+        return future
+
+    def _collect(self):
+        future, out_path = self.pending.popleft()
+        try:
+            future.result()
+        except Exception as e:
+            self.failed += 1
+            print(f"Fusing {out_path} failed: {e}")
+            return
+        print(f"Fused {out_path}")
+
+    def wait(self):
+        while self.pending:
+            self._collect()
+
+    def shutdown(self):
+        self.wait()
+        self.executor.shutdown()
+        if self.failed:
+            print(f"{self.failed} tiles failed to fuse")
@@ -1,44 +1,43 @@
-from pypylon import pylon
-from pypylon import genicam
-import time
+from camera import PylonCamera, SimulatedStage, SyntheticCamera
+from preview import Preview
 
 try:
-    imageWindow = pylon.PylonImageWindow()
-    imageWindow.Create(1)
-    # Create an instant camera object with the camera device found first.
-    camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
-
-    # Print the model name of the camera.
-    print("Using device ", camera.GetDeviceInfo().GetModelName())
-
-    # Start the grabbing of c_countOfImagesToGrab images.
-    # The camera device is parameterized with a default configuration which
-    # sets up free-running continuous acquisition.
-    camera.StartGrabbingMax(10000, pylon.GrabStrategy_LatestImageOnly)
-
-    while camera.IsGrabbing():
-        # Wait for an image and then retrieve it. A timeout of 5000 ms is used.
-        grabResult = camera.RetrieveResult(5000, pylon.TimeoutHandling_ThrowException)
-
-        # Image grabbed successfully?
-        if grabResult.GrabSucceeded():
-            imageWindow.SetImage(grabResult)
-            imageWindow.Show()
-        else:
-            print("Error: ",
-                  grabResult.ErrorCode)  # grabResult.ErrorDescription does not work properly in python could throw UnicodeDecodeError
-        grabResult.Release()
-        time.sleep(0.05)
-
-        if not imageWindow.IsVisible():
-            camera.StopGrabbing()
+    from pypylon import genicam
+    camera_errors = genicam.GenericException
+except ImportError:
+    # Synthetic backend only, nothing to catch
+    camera_errors = ()
+
+
+exposure_us = 50000 # Same fixed exposure and gain as the scan scripts, the live view shows what a scan captures
+gain_raw = 300
+camera_backend = "pylon" # "pylon" (Basler camera) or "synthetic" (simulated camera, no hardware)
+
+try:
+    # Frames are shown on the preview thread at a capped rate, the grab
+    # loop only hands over the latest one and never sleeps
+    preview = Preview(max_fps=20, scale=0.5, window="Live")
+    # Software-triggered frames go into the camera's ring buffers and on to
+    # the preview, nothing is allocated per frame
+    if camera_backend == "synthetic":
+        camera = SyntheticCamera(SimulatedStage("z"), preview=preview, exposure_us=exposure_us)
+    else:
+        camera = PylonCamera(exposure_us=exposure_us, gain_raw=gain_raw, preview=preview)
+
+    for _ in range(10000):
+        frame = camera.grab_frame()
+        if frame is not None:
+            frame.release()
+
+        # Esc, q or closing the window
+        if preview.closed:
+            break
 
     # camera has to be closed manually
-    camera.Close()
-    # imageWindow has to be closed manually
-    imageWindow.Close()
+    camera.close()
+    preview.close()
 
-except genicam.GenericException as e:
+except camera_errors as e:
     # Error handling.
     print("An exception occurred.")
-    print(e)
\ No newline at end of file
+    print(e)
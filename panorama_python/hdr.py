@@ -0,0 +1,132 @@
+import cv2
+import numpy as np
+
+
+# Exposure bracketing for scenes with more range than one 8-bit exposure
+# holds (shiny solder next to dark laminate). Every position is captured at
+# a few exposure times around the base exposure; the brackets are merged
+# into relative radiance and tone-mapped back to 8 bit.
+#
+# The sensor output is linear (gamma off), so radiance is the pixel value
+# divided by the exposure time, averaged over the brackets with a hat
+# weight that ignores clipped and near-black pixels. Radiance is relative to
+# the base exposure: 1.0 is what the base exposure shows as 255.
+#
+# Tone mapping is a fixed global Reinhard curve, not adapted to the image,
+# so every slice and every tile of a scan gets the same mapping and focus
+# fusion and stitching see consistent brightness. Everything is whole-array
+# OpenCV/NumPy on float32, no Python loop over pixels.
+
+hdr_key = 2.0  # Radiance scale before the curve, base exposure mid-grey stays near mid-grey
+
+
+def bracket_exposures(base_us, brackets=3, stops=2.0):
+    # Exposure times in us, `stops` apart and centred on base_us
+    return [int(round(base_us * 2 ** (stops * (k - (brackets - 1) / 2)))) for k in range(brackets)]
+
+
+def reference_bracket(brackets):
+    # Index of the bracket closest to the base exposure
+    return brackets // 2
+
+
+def merge_radiance(frames, exposures):
+    # Frames of one position, one per exposure time (any unit). Pixel values
+    # are 8 bit, so weight and weighted radiance per value come from lookup
+    # tables and the per-pixel work is a table lookup and an add.
+    base = exposures[reference_bracket(len(exposures))]
+    levels = np.arange(256, dtype=np.float32) / 255
+    # Hat weight, zero at both ends; the small floor keeps pixels that are
+    # clipped in every bracket defined
+    hat = np.maximum(1 - np.abs(2 * levels - 1), 1e-3).astype(np.float32)
+    numerator = np.zeros(frames[0].shape, dtype=np.float32)
+    weights = np.zeros(frames[0].shape, dtype=np.float32)
+    looked_up = np.empty(frames[0].shape, dtype=np.float32)
+    for frame, exposure in zip(frames, exposures):
+        cv2.add(numerator, cv2.LUT(frame, hat * levels * np.float32(base / exposure), dst=looked_up), dst=numerator)
+        cv2.add(weights, cv2.LUT(frame, hat, dst=looked_up), dst=weights)
+    return cv2.divide(numerator, weights, dst=numerator)
+
+
+def tone_map(radiance, white, key=hdr_key):
+    # Extended Reinhard on luminance, radiance `white` maps to 255
+    if radiance.ndim == 3:
+        luminance = cv2.transform(radiance, np.array([[0.114, 0.587, 0.299]], dtype=np.float32))
+    else:
+        luminance = radiance
+    scaled = luminance * np.float32(key)
+    white = np.float32(white * key)
+    # Ratio of mapped to original luminance, applied to every channel
+    ratio = (1 + scaled / (white * white)) / (1 + scaled) * np.float32(key * 255)
+    out = radiance * (ratio[..., np.newaxis] if radiance.ndim == 3 else ratio)
+    return np.clip(out, 0, 255, out=out).astype(np.uint8)
+
+
+def merge_brackets(frames, exposures, key=hdr_key):
+    # Brightest radiance the shortest exposure can record maps to white
+    white = exposures[reference_bracket(len(exposures))] / min(exposures)
+    return tone_map(merge_radiance(frames, exposures), white, key)
+
+
+class BracketFuser:
+    # Wraps a fuser for stacks captured with every bracket of a slice
+    # pushed in a row (exposures in order). Each full bracket is merged and
+    # the 8-bit result pushed to the wrapped fuser.
+
+    def __init__(self, fuser, exposures):
+        self.fuser = fuser
+        self.exposures = exposures
+        self.frames = []
+
+    def __len__(self):
+        return len(self.fuser)
+
+    @property
+    def z_positions(self):
+        return self.fuser.z_positions
+
+    def push(self, frame, z=None):
+        # Copied, frames can be camera buffers that get reused
+        self.frames.append(frame.copy())
+        if len(self.frames) == len(self.exposures):
+            self.fuser.push(merge_brackets(self.frames, self.exposures), z)
+            self.frames = []
+
+    def result(self):
+        return self.fuser.result()
+
+    def height_map(self, refine=True):
+        return self.fuser.height_map(refine)
+
+
+class BracketCollector:
+    # Gathers the bracket frames of a slice as they arrive (ring frames,
+    # released by the caller once used). A slice that did not get all its
+    # brackets is dropped whole, so a merge never mixes up exposures.
+
+    def __init__(self, brackets):
+        self.brackets = brackets
+        self.slice = None
+        self.frames = {}
+        self.incomplete = 0
+
+    def add(self, frame, slice_index, bracket):
+        # The slice's frames in exposure order once complete, else None
+        if slice_index != self.slice:
+            self.flush()
+            self.slice = slice_index
+        self.frames[bracket] = frame
+        if len(self.frames) < self.brackets:
+            return None
+        frames = [self.frames[k] for k in range(self.brackets)]
+        self.frames = {}
+        self.slice = None
+        return frames
+
+    def flush(self):
+        if self.frames:
+            self.incomplete += 1
+            print(f"Slice {self.slice}: {len(self.frames)} of {self.brackets} brackets arrived, slice dropped")
+        for frame in self.frames.values():
+            frame.release()
+        self.frames = {}
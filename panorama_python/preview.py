@@ -0,0 +1,103 @@
+import threading
+import time
+import cv2
+
+
+# Live preview off the acquisition path. The capture loop drops every frame
+# into a single-slot mailbox, which never blocks and simply replaces a frame
+# that was not shown yet. A frame's release callback, if any, runs then or
+# once the frame has been downscaled, so ring buffers go back early. A
+# display thread takes the latest frame, downscales it and shows it at no
+# more than max_fps. Capture and display rates are counted separately and
+# printed every report_seconds.
+#
+# The window is created and drawn on the display thread only, as HighGUI
+# wants. Closing it or pressing Esc/q sets `closed`, capture carries on.
+
+class Preview:
+
+    def __init__(self, max_fps=10, scale=0.25, window="Preview", report_seconds=10.0, convert=None):
+        self.min_interval = 1.0 / max_fps
+        self.scale = scale
+        self.convert = convert  # Applied on the display thread, e.g. demosaicing raw frames
+        self.window = window
+        self.report_seconds = report_seconds
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.frame = None
+        self.release = None
+        self.captured = 0
+        self.displayed = 0
+        self.closed = False
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, frame, release=None):
+        # Called from the capture loop, only swaps a reference
+        with self.lock:
+            replaced = self.release
+            self.frame, self.release = frame, release
+            self.captured += 1
+            # Set under the lock, _take() clears it under the lock too
+            self.ready.set()
+        if replaced is not None:
+            replaced()
+
+    def _take(self):
+        with self.lock:
+            frame, release = self.frame, self.release
+            self.frame, self.release = None, None
+            self.ready.clear()
+        return frame, release
+
+    def _run(self):
+        cv2.namedWindow(self.window, cv2.WINDOW_AUTOSIZE)
+        last_shown = 0.0
+        last_report = time.perf_counter()
+        captured, displayed = 0, 0
+        while not self.stopping:
+            now = time.perf_counter()
+            if now - last_report >= self.report_seconds:
+                elapsed = now - last_report
+                print(f"Preview: capture {(self.captured - captured) / elapsed:.1f} fps, "
+                      f"display {(self.displayed - displayed) / elapsed:.1f} fps")
+                last_report, captured, displayed = now, self.captured, self.displayed
+
+            # Rate cap first, frames arriving meanwhile just replace each other
+            wait = last_shown + self.min_interval - now
+            if wait > 0:
+                time.sleep(wait)
+            if not self.ready.wait(0.1):
+                self._poll_window()
+                continue
+            frame, release = self._take()
+            if frame is None:
+                continue
+
+            if self.convert is not None:
+                frame = self.convert(frame)
+            small = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+            if release is not None:
+                release()
+            cv2.imshow(self.window, small)
+            self.displayed += 1
+            last_shown = time.perf_counter()
+            self._poll_window()
+        cv2.destroyWindow(self.window)
+        _, release = self._take()
+        if release is not None:
+            release()
+
+    def _poll_window(self):
+        # waitKey also runs the HighGUI event loop
+        key = cv2.waitKey(1) & 0xFF
+        shown_and_closed = self.displayed and cv2.getWindowProperty(self.window, cv2.WND_PROP_VISIBLE) < 1
+        if key in (27, ord("q")) or shown_and_closed:
+            self.closed = True
+            self.stopping = True
+
+    def close(self):
+        self.stopping = True
+        self.thread.join()
+        print(f"Preview: {self.captured} frames captured, {self.displayed} displayed")
@@ -0,0 +1,94 @@
+import os
+import queue
+import threading
+import time
+
+from tile_formats import write_tile
+
+
+# Asynchronous image saving for the scan loops. The grab thread hands a
+# copy of the frame (or a ring buffer frame with its release callback) to a
+# bounded queue and carries on moving the stage; a
+# few encoder threads compress and write the files (the encoders release
+# the GIL, so threads are enough), in the format of the file extension.
+# The scan only waits when the queue is full, and that wait is counted so
+# that back-pressure shows in the logs.
+
+class SavePipeline:
+
+    def __init__(self, workers=2, depth=8, png_level=1, report_every=10):
+        self.depth = depth
+        self.png_level = png_level
+        self.report_every = report_every
+        self.queue = queue.Queue(maxsize=depth)
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.saved = 0
+        self.failed = 0
+        self.bytes_written = 0
+        self.encode_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.start_time = time.perf_counter()
+        self.threads = [threading.Thread(target=self._encode, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, frame, path, copy=True, release=None, meta=None):
+        # The frame is copied unless the caller hands over a buffer it no
+        # longer uses, release() is then called once it has been written;
+        # blocks only while the queue is full. meta goes to the .npy sidecar.
+        if copy:
+            frame = frame.copy()
+        start = time.perf_counter()
+        self.queue.put((frame, path, release, meta))
+        waited = time.perf_counter() - start
+        self.submitted += 1
+        if waited > 0.01:
+            self.wait_seconds += waited
+            print(f"Save queue full ({self.depth} frames), scan waited {waited:.2f} s")
+
+    def _encode(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            frame, path, release, meta = item
+            start = time.perf_counter()
+            try:
+                write_tile(path, frame, self.png_level, meta)
+                size = os.path.getsize(path)
+            except Exception as e:
+                print(f"Saving {path} failed: {e}")
+                with self.lock:
+                    self.failed += 1
+                continue
+            finally:
+                if release is not None:
+                    release()
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.saved += 1
+                self.bytes_written += size
+                self.encode_seconds += seconds
+                report = self.saved % self.report_every == 0
+            if report:
+                self.report()
+
+    def report(self):
+        with self.lock:
+            saved, encode_seconds, bytes_written = self.saved, self.encode_seconds, self.bytes_written
+        elapsed = time.perf_counter() - self.start_time
+        per_frame = encode_seconds / saved * 1000 if saved else 0.0
+        print(f"Save pipeline: {saved}/{self.submitted} saved, queue {self.queue.qsize()}/{self.depth}, "
+              f"{per_frame:.0f} ms encode per frame, {saved / elapsed:.2f} frames/s, "
+              f"{bytes_written / 2**20 / elapsed:.1f} MiB/s written, scan waited {self.wait_seconds:.1f} s")
+
+    def close(self):
+        # Waits for every queued frame to be written
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.report()
+        if self.failed:
+            print(f"Save pipeline: {self.failed} frames failed to save")
@@ -0,0 +1,169 @@
+import csv
+import json
+import math
+import os
+import time
+
+import cv2
+import numpy as np
+
+from demosaic import green_plane
+
+
+# Stage settling after a move. Instead of a fixed worst-case sleep, small
+# grayscale copies of the frames that follow a move are compared by phase
+# correlation, and the stage counts as settled once the shift between
+# consecutive frames stays below threshold pixels (of the width-pixel copy)
+# for still_frames frame pairs. The settle time is when the first of those
+# still frames was taken, measured from the end of the move.
+#
+# Every settle time is logged per axis and move length, and the longest
+# time per axis and power-of-two move length makes a table (save()). A
+# SettleTable loaded from it sleeps the calibrated time instead, for runs
+# where no frames should be spent on watching.
+#
+#   settle = SettleDetector(pixel_format=cam.pixel_format)
+#   x_stage.move(steps)
+#   settle.wait(cam, "x", steps)
+
+def move_bucket(steps):
+    # Moves are grouped by the power of two at or above their length
+    return 2 ** math.ceil(math.log2(max(abs(int(steps)), 1)))
+
+
+class SettleDetector:
+
+    def __init__(self, threshold=0.25, still_frames=2, timeout=3.0, width=256, pixel_format=None, log_path=None):
+        self.threshold = threshold  # Pixels of the width-pixel copy, 0.25 is about 1 px of a 1296 px frame
+        self.still_frames = still_frames
+        self.timeout = timeout  # Seconds, a stage still moving after this counts as settled with a warning
+        self.width = width
+        self.pixel_format = pixel_format  # Raw Bayer frames are compared on their green sites
+        self.log_path = log_path
+        self.times = {}  # (axis, bucket) -> settle times in seconds
+        self.timeouts = 0
+        self.window = None
+        self.axis = None
+
+    def start(self, axis, steps):
+        # Call right after the move returned
+        self.axis = axis
+        self.steps = steps
+        self.start_time = time.perf_counter()
+        self.previous = None
+        self.previous_time = None
+        self.still = 0
+        self.still_since = None
+        self.frames = 0
+
+    def _prepare(self, image):
+        gray = green_plane(image, self.pixel_format)
+        if gray.ndim == 3:
+            gray = cv2.cvtColor(gray, cv2.COLOR_BGR2GRAY)
+        scale = self.width / gray.shape[1]
+        small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA).astype(np.float32)
+        if self.window is None or self.window.shape != small.shape:
+            self.window = cv2.createHanningWindow((small.shape[1], small.shape[0]), cv2.CV_32F)
+        # Windowed here, phaseCorrelate gets fresh arrays
+        return small * self.window
+
+    def add(self, image):
+        # True once the stage has settled (or timed out); image is None for a missed frame
+        now = time.perf_counter()
+        if image is not None:
+            current = self._prepare(image)
+            self.frames += 1
+            if self.previous is not None and self.previous.shape == current.shape:
+                (dx, dy), _ = cv2.phaseCorrelate(self.previous, current)
+                if math.hypot(dx, dy) < self.threshold:
+                    if self.still == 0:
+                        self.still_since = self.previous_time
+                    self.still += 1
+                else:
+                    self.still = 0
+            self.previous, self.previous_time = current, now
+            if self.still >= self.still_frames:
+                self._record(self.still_since - self.start_time, True)
+                return True
+        if now - self.start_time > self.timeout:
+            self.timeouts += 1
+            print(f"Stage {self.axis} still moving {self.timeout} s after a {self.steps} step move, going on")
+            self._record(now - self.start_time, False)
+            return True
+        return False
+
+    def wait(self, camera, axis, steps):
+        # Grabs frames until the stage has settled, returns the seconds waited
+        self.start(axis, steps)
+        while True:
+            frame = camera.grab_frame()
+            if frame is None:
+                settled = self.add(None)
+            else:
+                with frame:
+                    settled = self.add(frame.array)
+            if settled:
+                return time.perf_counter() - self.start_time
+
+    def _record(self, seconds, settled):
+        seconds = max(seconds, 0.0)
+        self.times.setdefault((self.axis, move_bucket(self.steps)), []).append(seconds)
+        if self.log_path is None:
+            return
+        new_file = not os.path.exists(self.log_path)
+        with open(self.log_path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if new_file:
+                writer.writerow(["axis", "steps", "seconds", "frames", "settled"])
+            writer.writerow([self.axis, self.steps, round(seconds, 3), self.frames, settled])
+
+    def table(self):
+        # {axis: {bucket: longest settle time}}
+        table = {}
+        for (axis, bucket), times in sorted(self.times.items()):
+            table.setdefault(axis, {})[str(bucket)] = round(max(times), 3)
+        return table
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.table(), f, indent=1)
+
+    def report(self):
+        for (axis, bucket), times in sorted(self.times.items()):
+            print(f"Settle {axis} moves up to {bucket} steps: {len(times)} moves, "
+                  f"mean {np.mean(times) * 1000:.0f} ms, longest {max(times) * 1000:.0f} ms")
+        if self.timeouts:
+            print(f"Settle: {self.timeouts} moves timed out after {self.timeout} s")
+
+
+class SettleTable:
+    # Calibrated settle times from SettleDetector.save(), without a camera
+
+    def __init__(self, table, margin=1.2, default=1.0):
+        self.table = {axis: {int(bucket): seconds for bucket, seconds in buckets.items()}
+                      for axis, buckets in table.items()}
+        self.margin = margin  # Factor on the longest measured time
+        self.default = default  # Seconds for an axis that was never measured
+
+    @classmethod
+    def load(cls, path, margin=1.2, default=1.0):
+        with open(path) as f:
+            return cls(json.load(f), margin, default)
+
+    def delay(self, axis, steps):
+        buckets = self.table.get(axis)
+        if not buckets:
+            return self.default
+        # The smallest measured bucket that covers the move, else the largest
+        bucket = move_bucket(steps)
+        covering = [b for b in buckets if b >= bucket]
+        return buckets[min(covering) if covering else max(buckets)] * self.margin
+
+    def wait(self, camera, axis, steps):
+        # Same call as SettleDetector.wait, the camera is not used
+        seconds = self.delay(axis, steps)
+        time.sleep(seconds)
+        return seconds
+
+    def report(self):
+        print(f"Settle: calibrated delays, {self.margin} x the longest measured time")
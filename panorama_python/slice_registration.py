@@ -0,0 +1,156 @@
+import json
+import cv2
+import numpy as np
+
+from demosaic import warp_mosaic
+
+
+# Cancels focus breathing before fusion. Moving z scales and shifts the image
+# slightly, so every slice is mapped onto the first slice of the sweep with a
+# similarity transform (scale + shift, the optics do not rotate), estimated
+# on a downscaled grayscale frame by phase correlation and refined with ECC.
+#
+# The transforms depend on the optics, not the sample, so they are cached by
+# z offset from the sweep start and every tile after the first just warps.
+
+registration_scale = 0.25  # Downscale factor used for estimation
+
+
+def _prepare(image, scale=registration_scale):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return small.astype(np.float32)
+
+
+def _scale_about_center(zoom, width, height):
+    cx, cy = width / 2, height / 2
+    return np.array([[zoom, 0, cx * (1 - zoom)],
+                     [0, zoom, cy * (1 - zoom)]], dtype=np.float64)
+
+
+def estimate_similarity(reference, moving, scale=registration_scale, iterations=50):
+    # 2x3 matrix that warps the full-resolution moving frame onto reference.
+    # Both can be frames or already prepared downscaled grayscale.
+    ref = reference if reference.dtype == np.float32 and reference.ndim == 2 else _prepare(reference, scale)
+    mov = moving if moving.dtype == np.float32 and moving.ndim == 2 else _prepare(moving, scale)
+    height, width = ref.shape
+
+    # Phase correlation gets the shift to within a pixel, ECC then refines
+    # zoom and shift to sub-pixel accuracy. Windowed into fresh arrays, some
+    # OpenCV builds window the inputs of phaseCorrelate in place.
+    window = cv2.createHanningWindow((width, height), cv2.CV_32F)
+    (dx, dy), _ = cv2.phaseCorrelate(ref * window, mov * window)
+    forward = np.array([[1, 0, dx], [0, 1, dy]], dtype=np.float32)
+    try:
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, iterations, 1e-5)
+        _, forward = cv2.findTransformECC(ref, mov, forward, cv2.MOTION_AFFINE, criteria, None, 5)
+    except cv2.error:
+        print("ECC did not converge, using the phase correlation shift only")
+
+    # Keep the similarity part: the mean zoom, no rotation or shear. The
+    # forward matrix maps reference pixels onto moving pixels.
+    zoom = (forward[0, 0] + forward[1, 1]) / 2
+    forward = np.array([[zoom, 0, forward[0, 2] / scale],
+                        [0, zoom, forward[1, 2] / scale]], dtype=np.float64)
+    return cv2.invertAffineTransform(forward)
+
+
+def _copy_into(buffer, frame):
+    # Reuses buffer when it fits
+    if buffer is None or buffer.shape != frame.shape or buffer.dtype != frame.dtype:
+        return frame.copy()
+    np.copyto(buffer, frame)
+    return buffer
+
+
+def _compose(outer, inner):
+    # Matrix applying inner first, then outer
+    return (np.vstack([outer, [0, 0, 1]]) @ np.vstack([inner, [0, 0, 1]]))[:2]
+
+
+class SliceAligner:
+    # Slices are registered to their neighbour and chained back to the
+    # reference offset, neighbouring slices differ least in focus. Offsets
+    # that cannot be chained (a slice went missing on the first tile) stay
+    # unregistered until a later tile fills them in.
+
+    def __init__(self, scale=registration_scale, max_shift=0.05, bayer=False):
+        self.scale = scale
+        self.bayer = bayer  # Raw Bayer frames, warped per colour site
+        self.max_shift = max_shift  # Reject estimates moving more than this fraction of the frame
+        self.transforms = {}
+        self.previous = None
+        self.unregistered = set()  # Offsets seen but not registered yet
+        self.kept = None  # Copy of the previous slice while it may still be needed
+        self.warped = None  # Output buffer, reused for every slice
+
+    def start_tile(self):
+        self.previous = None
+
+    def registered(self, z_offsets):
+        # False while a transform is still to be estimated; shake in those
+        # slices would end up in the transform and in every later tile
+        return all(z_offset in self.transforms for z_offset in z_offsets)
+
+    def align(self, frame, z_offset):
+        # The returned frame may be the aligner's buffer, valid until the
+        # next call; the fusers copy what they keep
+        self.register(frame, z_offset)
+        return self.warp(frame, z_offset)
+
+    def register(self, frame, z_offset):
+        # Estimates the transform of a new offset, without warping
+        new = z_offset not in self.transforms
+        if new:
+            self._estimate(frame, z_offset)
+        if z_offset in self.transforms:
+            self.unregistered.discard(z_offset)
+        else:
+            self.unregistered.add(z_offset)
+        if new or self.unregistered:
+            # The next slice may need this one. The frame can be a camera
+            # buffer that is reused after this call, so it is copied.
+            self.kept = _copy_into(self.kept, frame)
+            self.previous = (z_offset, self.kept)
+        else:
+            # Registered tile: the next offset is registered too
+            self.previous = (z_offset, None)
+
+    def warp(self, frame, z_offset):
+        # Applies the cached transform, unregistered offsets pass through
+        matrix = self.transforms.get(z_offset)
+        if matrix is None or np.allclose(matrix, [[1, 0, 0], [0, 1, 0]], atol=1e-3):
+            return frame
+        if self.warped is None or self.warped.shape != frame.shape or self.warped.dtype != frame.dtype:
+            self.warped = np.empty_like(frame)
+        if self.bayer:
+            return warp_mosaic(frame, matrix, self.warped)
+        height, width = frame.shape[:2]
+        return cv2.warpAffine(frame, matrix, (width, height), dst=self.warped, flags=cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_REPLICATE)
+
+    def _estimate(self, frame, z_offset):
+        if not self.transforms:
+            # The first slice ever seen is the reference
+            self.transforms[z_offset] = np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)
+            return
+        if self.previous is None or self.previous[0] not in self.transforms or self.previous[1] is None:
+            return
+
+        prev_offset, prev_frame = self.previous
+        step = estimate_similarity(prev_frame, frame, self.scale)
+        height, width = frame.shape[:2]
+        if np.abs(step[:, 2] - _scale_about_center(step[0, 0], width, height)[:, 2]).max() > self.max_shift * max(width, height):
+            print(f"Registration of z offset {z_offset} rejected, shift too large")
+            return
+        self.transforms[z_offset] = _compose(self.transforms[prev_offset], step)
+        print(f"Registered z offset {z_offset}: scale {self.transforms[z_offset][0, 0]:.4f}, "
+              f"shift ({self.transforms[z_offset][0, 2]:.1f}, {self.transforms[z_offset][1, 2]:.1f}) px")
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({str(k): m.tolist() for k, m in self.transforms.items()}, f)
+
+    def load(self, path):
+        with open(path) as f:
+            self.transforms = {int(k): np.array(m) for k, m in json.load(f).items()}
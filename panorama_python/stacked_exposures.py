@@ -1,11 +1,20 @@
-from pypylon import pylon
 import time
-import urllib.request
 import os
-import cv2
-import numpy as np
 
-from itertools import product
+from camera import PylonCamera, SimulatedStage, SyntheticCamera
+from demosaic import DemosaicFuser, is_bayer
+from focus_fusion import make_fuser, save_fused, stack_fuser
+from frame_store import FrameStore
+from hdr import BracketCollector, BracketFuser, bracket_exposures, reference_bracket
+from fusion_pool import FusionPool
+from focus_frames import FocusFrames
+from focus_map import FocusMap
+from focus_metrics import FocusMetric
+from focus_search import FocusProbe, fit_peak, log_search, make_search
+from preview import Preview
+from settle import SettleDetector, SettleTable
+from slice_registration import SliceAligner
+from stage import StageAxis
 
 #AD7177
 x_step_size = 20
@@ -28,197 +37,281 @@ y_step_count = 20
 
 autofocus_range = 200  # Total range (in steps) to search for focus
 autofocus_step_size = 20 # Smaller step size for autofocusing
-
-imageWindow = pylon.PylonImageWindow()
-imageWindow.Create(1)
-
-img = pylon.PylonImage()
-
-cam = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
-
-# Register the standard configuration event handler for enabling software triggering.
-# The software trigger configuration handler replaces the default configuration
-# as all currently registered configuration handlers are removed by setting the registration mode to RegistrationMode_ReplaceAll.
-cam.RegisterConfiguration(pylon.SoftwareTriggerConfiguration(), pylon.RegistrationMode_ReplaceAll,
-                          pylon.Cleanup_Delete)
-
-cam.Open()
-print("Using device ", cam.GetDeviceInfo().GetModelName())
-
-
-# Set the Exposure Auto auto function to its minimum lower limit
-# and its maximum upper limit
-#minLowerLimit = cam.AutoExposureTimeLowerLimitRaw.Min
-#maxUpperLimit = cam.AutoExposureTimeUpperLimitRaw.Max
-#cam.AutoExposureTimeLowerLimitRaw.Value = minLowerLimit
-#cam.AutoExposureTimeUpperLimitRaw.Value = maxUpperLimit
-# Set the target brightness value to 128
-#cam.AutoTargetValue.Value = 128
-# Select auto function ROI 1
-#cam.AutoFunctionAOISelector.Value = "AOI1"
-# Enable the 'Intensity' auto function (Gain Auto + Exposure Auto)
-# for the auto function ROI selected
-#cam.AutoFunctionAOIUsageIntensity.Value = True
-# Enable Exposure Auto by setting the operating mode to Continuous
-#cam.ExposureAuto.Value = "Continuous"
-
-
-# Or better set everything to constant for pano stitching
-cam.ExposureAuto.SetValue("Off")
-cam.ExposureMode.SetValue("Timed")
-cam.ExposureTimeAbs.SetValue(50000)
-
-cam.GainAuto.SetValue("Off")
-cam.GainRaw.SetValue(300)
-
-
-
-
-cam.StartGrabbing(pylon.GrabStrategy_LatestImageOnly)
-
-
-converter = pylon.ImageFormatConverter()
-
-# converting to opencv bgr format
-converter.OutputPixelFormat = pylon.PixelType_BGR8packed
-converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
-
-
-timestr = time.strftime("%Y%m%d-%H%M%S")
-if not os.path.exists(timestr):
-    os.makedirs(timestr)
-
-x_dir = -1 # For snake-like back n forth movement
-x_coord = 0 # At what step we are for file naming
-
-def make_laplacian(image):
-    image_filtered = cv2.medianBlur(image, 1)
-    gray = cv2.cvtColor(image_filtered, cv2.COLOR_RGB2GRAY, cv2.CV_64F) / 255.0
-    return cv2.Laplacian(image_filtered, cv2.CV_64F)
-
-def variance_of_laplacian(image):
-    image_filtered = cv2.medianBlur(image, 1)
-    return make_laplacian(image_filtered).var()
-
-def autofocus(cam, z_axis_url_base, autofocus_range, autofocus_step_size):
-    print("Starting autofocus...")
-    best_focus_score = -1
-    best_z_pos = 0
-
-    # Store (focus_score, z_position) pairs
-    focus_scores_and_positions = []
-
-    # Move to the start of the sweep
-    url = f"{z_axis_url_base}?steps={int(autofocus_range/2)}&dir=pos"
-    urllib.request.urlopen(url).read()
-
-    # Sweep through the autofocus range
-    for z_move in range(int(autofocus_range/autofocus_step_size)):
-        url = f"{z_axis_url_base}?steps={autofocus_step_size}&dir=neg"
-        with urllib.request.urlopen(url) as response:
-            html_content = response.read().decode('utf-8')
-        
-        # Extract current pos
-        start_tag = '<span id="z_pos">'
-        end_tag = '</span>'
-        start_index = html_content.find(start_tag)
-        end_index = html_content.find(end_tag, start_index)
-        value_str = html_content[start_index + len(start_tag):end_index]
-        current_z_pos = int(value_str)
-
-        # Capture an image
-        if cam.WaitForFrameTriggerReady(1000, pylon.TimeoutHandling_ThrowException):
-            cam.ExecuteSoftwareTrigger()
-            time.sleep(1) # Small delay for cam to capture
-            with cam.RetrieveResult(0, pylon.TimeoutHandling_Return) as result:
-                imageWindow.SetImage(result)
-                imageWindow.Show()
-                if result.GrabSucceeded():
-                    # Convert Pylon image to OpenCV format
-                    image = converter.Convert(result)
-                    img_np = image.GetArray()
-
-                    # Calculate focus score
-                    focus_score = variance_of_laplacian(img_np)
-                    focus_scores_and_positions.append((focus_score, current_z_pos))
-                    print(f"Z-pos: {current_z_pos}, Focus Score: {focus_score}")
-
-                    if focus_score > best_focus_score:
-                        best_focus_score = focus_score
-                        best_z_pos = current_z_pos
-
-    print(f"Autofocus complete. Best focus score: {best_focus_score} at Z-pos: {best_z_pos}")
+autofocus_strategy = "golden_section" # "linear", "coarse_to_fine", "golden_section", "hill_climb" or "continuous" (one z move, camera free-runs)
+autofocus_backlash = 0 # Upward moves overshoot by this many steps and come back down, so every sample is approached from above
+autofocus_peak_fit = "gaussian" # Interpolate the best z between samples: "parabolic", "gaussian" or None
+use_focus_map = True # Predict z from earlier tiles and only verify it, full autofocus when the check fails
+single_pass_acquisition = True # The stack sweep of a tile doubles as its autofocus, no separate autofocus sweep
+focus_metric = "laplacian_variance" # "laplacian_variance", "tenengrad", "brenner" or "normalized_variance"
+focus_downscale = 0.5 # Autofocus scores a grayscale frame downscaled by this factor
+focus_roi = 0.5 # Centred fraction of the frame, (x, y, width, height) in pixels or None for the whole frame
+focus_camera_frames = True # Autofocus frames read out only focus_roi, binned by 1/focus_downscale, when switching pays off
+settle_threshold = 0.25 # After a move the stage counts as settled once frames shift less than this (pixels across a 256 px copy)
+settle_table = None # settle_table.json of an earlier scan: sleep its calibrated times instead of watching frames
+
+fusion_mode = "argmax" # "argmax" (fast, per pixel) or "pyramid" (multi-scale, smoother seams)
+fusion_workers = 4 # Background fusion processes, 0 fuses inline and blocks the scan loop
+keep_raw_stacks = False # Keep every slice in a memory-mapped frame store next to the fused tile
+save_height_maps = True # 16-bit height map in stage steps next to every fused tile
+register_slices = True # Cancel focus breathing, transforms are estimated on the first tile and reused
+tile_format = "png" # Fused tiles as "png", "tiff" (uncompressed, fast) or "npy" (raw array)
+png_compression = 1 # 0 (fastest, largest) to 9 (slowest, smallest)
+burst_buffers = 32 # Grab buffers for lossless burst stacks (one by one, drops detected by frame ID), 0 waits for every slice
+exposure_us = 50000 # Base exposure time, fixed for the whole scan
+gain_raw = 300
+hdr_brackets = 1 # Exposures per slice, e.g. 3 brackets around exposure_us merged to HDR in the fusion pool; 1 is off
+hdr_stops = 2.0 # Exposure ratio between brackets, in stops
+raw_capture = False # Keep the sensor's Bayer/mono frames (a third of the bytes), demosaic on the fusion workers
+camera_backend = "pylon" # "pylon" (Basler camera, Pico W stage) or "synthetic" (simulated camera and stage, no hardware)
+preview_fps = 10 # Live preview rate cap, shown on its own thread; 0 disables the preview
+preview_scale = 0.25 # Preview downscale factor
+
+focus_score = FocusMetric(focus_metric, focus_downscale, focus_roi)
+exposure_brackets = bracket_exposures(exposure_us, hdr_brackets, hdr_stops)
+hdr_exposures = exposure_brackets if hdr_brackets > 1 else None # Handed to the fusers, which merge the brackets
+
+def focus_probe(cam, z_stage):
+    # Every autofocus capture waits until the z move has settled
+    return FocusProbe(z_stage, focus_frames.score, autofocus_backlash,
+                      lambda steps: settle.wait(cam, "z", steps))
+
+def autofocus(cam, z_stage, search, center=None):
+    print(f"Starting autofocus ({search.name})...")
+    if center is None:
+        center = z_stage.read_position()
+
+    probe = focus_probe(cam, z_stage)
+    search.run(probe, center)
+    best_sample_z, best_focus_score = probe.best()
+    # Sub-step focus from the shape of the score curve around the best sample
+    best_z_pos = int(round(fit_peak(probe.samples, autofocus_peak_fit)))
+
+    print(f"Autofocus complete. Best focus score: {best_focus_score} at Z-pos: {best_sample_z}, fitted peak at {best_z_pos}")
 
     # Move to the best focus position
-    final_move_steps = best_z_pos - current_z_pos
-
-    if final_move_steps > 0:
-        url = f"{z_axis_url_base}?steps={abs(final_move_steps)}&dir=pos"
-    elif final_move_steps < 0:
-        url = f"{z_axis_url_base}?steps={abs(final_move_steps)}&dir=neg"
-    else:
+    if z_stage.position == best_z_pos:
         print("Already at optimal focus position.")
-        return best_z_pos
-
-    try:
-        urllib.request.urlopen(url).read()
-        time.sleep(0.5)
-        print(f"Moved Z-axis to optimal position: {best_z_pos}")
-    except Exception as e:
-        print(f"Error moving Z-axis to optimal position: {e}")
-    
+    else:
+        try:
+            steps = best_z_pos - z_stage.position
+            probe.move_to(best_z_pos)
+            settle.wait(cam, "z", steps)
+            print(f"Moved Z-axis to optimal position: {best_z_pos}")
+        except Exception as e:
+            print(f"Error moving Z-axis to optimal position: {e}")
+
+    stats = probe.stats(search)
+    stats["fitted_z"] = best_z_pos
+    print(f"Autofocus used {stats['moves']} moves, {stats['captures']} captures, {stats['seconds']} s")
+    log_search(f'{timestr}/autofocus_stats.csv', stats)
+
+    return best_z_pos, best_focus_score
+
+def focus_tile(cam, z_stage, stage_x, stage_y, center=None):
+    # Full frames again for the stack that follows
+    with focus_frames:
+        return _focus_tile(cam, z_stage, stage_x, stage_y, center)
+
+def _focus_tile(cam, z_stage, stage_x, stage_y, center=None):
+    # Focus from the focus map when it can be trusted, full autofocus otherwise
+    if focus_map is not None and len(focus_map) > 0:
+        predicted = focus_map.predict(stage_x, stage_y)
+        print(f"Focus map predicts Z-pos {predicted:.1f}, verifying...")
+        probe = focus_probe(cam, z_stage)
+        verified_z, score = focus_map.verify(probe, predicted)
+        verified_z = int(round(verified_z))
+        if focus_map.accept(stage_x, stage_y, verified_z, score, predicted):
+            steps = verified_z - z_stage.position
+            probe.move_to(verified_z)
+            settle.wait(cam, "z", steps)
+            print(f"Focus map accepted, Z-pos {verified_z} after {probe.captures} captures")
+            return verified_z
+        center = verified_z
+
+    best_z_pos, best_focus_score = autofocus(cam, z_stage, autofocus_search, center)
+    if focus_map is not None:
+        focus_map.add(stage_x, stage_y, best_z_pos, best_focus_score)
     return best_z_pos
 
-def combine_exposures(cam, y, x, z_axis_url_base, autofocus_range, autofocus_step_size):
+def add_slice(frames, z_move, z, fuser, samples):
+    # All brackets of a slice in exposure order, a single frame without
+    # bracketing. The fusers copy what they keep, the frames go back to the camera.
+    if frames is None:
+        return
+    try:
+        reference = frames[reference_bracket(len(frames))].array
+        samples[z] = focus_score(reference)
+        if slice_aligner is not None:
+            # Offset from the sweep start, the same on every tile; estimated
+            # on the base exposure, the other brackets reuse the transform
+            slice_aligner.register(reference, z_move*autofocus_step_size)
+        for frame in frames:
+            img_np = frame.array
+            if slice_aligner is not None:
+                img_np = slice_aligner.warp(img_np, z_move*autofocus_step_size)
+            fuser.push(img_np, z)
+    finally:
+        for frame in frames:
+            frame.release()
+
+def combine_exposures(cam, y, x, z_stage, autofocus_range, autofocus_step_size):
+    # Captures and saves one tile, returns the focus score per z
+    fuser, samples = capture_stack(cam, y, x, z_stage, autofocus_range, autofocus_step_size)
+    save_stack(fuser, y, x)
+    return samples
+
+def capture_stack(cam, y, x, z_stage, autofocus_range, autofocus_step_size):
+    # The tile's stack, not yet fused or saved, and the focus score per z
     print("Starting capture of exposures...")
 
     # Move to the start of the sweep
-    url = f"{z_axis_url_base}?steps={int(autofocus_range/2)}&dir=pos"
-    urllib.request.urlopen(url).read()
-
-    images = list()
+    z_stage.move(int(autofocus_range/2))
+
+    slices = int(autofocus_range/autofocus_step_size)
+    brackets = len(exposure_brackets)
+    if keep_raw_stacks:
+        # Slices land in a memmap on disk and are fused from there
+        fuser = FrameStore(f'{timestr}/y{y}_x{x}_stack', slices*brackets, cam.pixel_format)
+    elif fusion_pool is not None:
+        # Slices go straight into shared memory for a background worker,
+        # which also does the HDR merge and demosaicing
+        fuser = fusion_pool.stack(slices, hdr_exposures, cam.pixel_format)
+    else:
+        # In argmax mode frames are fused as they arrive, nothing is kept per slice
+        fuser = make_fuser(fusion_mode, track_depth=save_height_maps)
+        if hdr_exposures is not None:
+            fuser = BracketFuser(fuser, hdr_exposures)
+        if is_bayer(cam.pixel_format):
+            fuser = DemosaicFuser(fuser, cam.pixel_format)
+    # Slices that registration is estimated from are taken one by one with
+    # the stage at rest, a burst would take them while it still shakes
+    estimating = slice_aligner is not None and not slice_aligner.registered(
+        [z_move*autofocus_step_size for z_move in range(slices)])
+    burst = None if estimating else cam.burst
+    if slice_aligner is not None:
+        slice_aligner.start_tile()
+    samples = {} # Focus score per z, the sweep is also an autofocus sweep
+    collector = BracketCollector(brackets)
+    if burst is not None:
+        burst.start(f"y{y}_x{x}")
     # Sweep through the autofocus range
-    for z_move in range(int(autofocus_range/autofocus_step_size)):
-        url = f"{z_axis_url_base}?steps={autofocus_step_size}&dir=neg"
-        with urllib.request.urlopen(url) as response:
-            html_content = response.read().decode('utf-8')
-        
-        # Extract current pos
-        start_tag = '<span id="z_pos">'
-        end_tag = '</span>'
-        start_index = html_content.find(start_tag)
-        end_index = html_content.find(end_tag, start_index)
-        value_str = html_content[start_index + len(start_tag):end_index]
-        current_z_pos = int(value_str)
-
-        # Capture an image
-        if cam.WaitForFrameTriggerReady(1000, pylon.TimeoutHandling_ThrowException):
-            cam.ExecuteSoftwareTrigger()
-            time.sleep(1) # Small delay for cam to capture
-            with cam.RetrieveResult(0, pylon.TimeoutHandling_Return) as result:
-                imageWindow.SetImage(result)
-                imageWindow.Show()
-                if result.GrabSucceeded():
-                    # Convert Pylon image to OpenCV format
-                    image = converter.Convert(result)
-                    img_np = image.GetArray()
-                    images.append(img_np)
-
-    print("Combining exposures")
-    laplacians = list(map(make_laplacian, img_np))
-
-    shape = images[0].shape
-    combined = np.zeros(shape)
-    for i, j in product(range(shape[0]), range(shape[1])):
-        max_index = -1
-        max_value = float('-inf')
-        for k, im in enumerate(images):
-            if laplacians[k][i, j] > max_value:
-                max_index = k
-
-        combined[i, j] = images[k][i, j]
-
-    cv2.imwrite(f'{timestr}/y{y}_x{x}.png', result)
+    for z_move in range(slices):
+        current_z_pos = z_stage.move(-autofocus_step_size)
+        if estimating:
+            settle.wait(cam, "z", -autofocus_step_size)
+
+        for bracket, exposure in enumerate(exposure_brackets):
+            if brackets > 1:
+                cam.set_exposure(exposure)
+            if burst is not None:
+                # Returns once the exposure is over, the frame is handled
+                # when it has arrived and the stage is already on its way
+                burst.trigger(current_z_pos)
+                continue
+            # Capture an image
+            frame = cam.grab_frame()
+            if frame is not None:
+                add_slice(collector.add(frame, z_move, bracket), z_move, current_z_pos, fuser, samples)
+
+        if burst is not None:
+            for frame, index, slice_z in cam.burst_slices():
+                add_slice(collector.add(frame, index // brackets, index % brackets), index // brackets, slice_z,
+                          fuser, samples)
+
+    if burst is not None:
+        for frame, index, slice_z in cam.burst_slices(wait=True):
+            add_slice(collector.add(frame, index // brackets, index % brackets), index // brackets, slice_z,
+                      fuser, samples)
+    collector.flush()
+    if brackets > 1:
+        cam.set_exposure(exposure_us)
+    return fuser, samples
+
+def discard_stack(fuser):
+    # A stack that gets captured again: nothing of it is queued or written,
+    # so the retry cannot race it for the same output files
+    if keep_raw_stacks:
+        fuser.discard()
+    elif fusion_pool is not None:
+        fuser.release()
+
+def save_stack(fuser, y, x):
+    out_path = f'{timestr}/y{y}_x{x}.{tile_format}'
+    if len(fuser) == 0:
+        print(f"No frames captured for y{y}_x{x}, nothing to save")
+        discard_stack(fuser)
+        return
+
+    if keep_raw_stacks:
+        fuser.close()
+        if fusion_pool is not None:
+            print(f"Queued {len(fuser)} stored exposures for fusion")
+            fusion_pool.submit_store(fuser.path, out_path, hdr_exposures)
+            return
+        store = FrameStore.open(fuser.path)
+        fuser = stack_fuser(store.stack(), fusion_mode, store.z_positions, track_depth=save_height_maps,
+                            exposures=hdr_exposures, pixel_format=store.pixel_format)
+    elif fusion_pool is not None:
+        print(f"Queued {len(fuser)} exposures for fusion")
+        fusion_pool.submit(fuser, out_path)
+        return
+
+    print(f"Fused {len(fuser)} exposures")
+    save_fused(fuser, out_path, save_height_maps, png_level=png_compression)
+
+def scan_tile(cam, y, x, z_stage, center=None):
+    # Focus and capture one tile, returns the focus to centre the next tile on
+    stage_x, stage_y = x*x_step_size, y*y_step_size
+    if not single_pass_acquisition:
+        center = focus_tile(cam, z_stage, stage_x, stage_y, center)
+        combine_exposures(cam, y, x, z_stage, autofocus_range, autofocus_step_size)
+        return center
+
+    # The stack is centred on the expected focus and its focus scores give
+    # the tile's best z. Only the first tile needs a separate autofocus, the
+    # focus map gets every tile once, from its stack.
+    predicted = False
+    if center is None:
+        with focus_frames:
+            center, _ = autofocus(cam, z_stage, autofocus_search)
+    elif focus_map is not None and len(focus_map) > 0:
+        center = int(round(focus_map.predict(stage_x, stage_y)))
+        predicted = True
+    z_stage.move_to(center)
+
+    start_moves, start_time = z_stage.moves, time.perf_counter()
+    fuser, samples = capture_stack(cam, y, x, z_stage, autofocus_range, autofocus_step_size)
+    if not samples:
+        save_stack(fuser, y, x)
+        return center
+    best_sample_z, best_focus_score = max(samples.items(), key=lambda item: item[1])
+    if best_sample_z in (min(samples), max(samples)):
+        # Sharpest at the end of the sweep, the focus may lie outside of it
+        print(f"Focus peak at the edge of the stack (Z-pos {best_sample_z}), autofocusing and capturing again")
+        discard_stack(fuser)
+        with focus_frames:
+            center, best_focus_score = autofocus(cam, z_stage, autofocus_search, best_sample_z)
+        if focus_map is not None:
+            focus_map.add(stage_x, stage_y, center, best_focus_score)
+        combine_exposures(cam, y, x, z_stage, autofocus_range, autofocus_step_size)
+        return center
+
+    save_stack(fuser, y, x)
+    best_z_pos = int(round(fit_peak(samples, autofocus_peak_fit)))
+    z_stage.move_to(best_z_pos)
+    print(f"Tile focus from the stack: best score {best_focus_score} at Z-pos {best_sample_z}, fitted peak at {best_z_pos}")
+    log_search(f'{timestr}/autofocus_stats.csv', {
+        "strategy": "single_pass",
+        "moves": z_stage.moves - start_moves,
+        "captures": len(samples),
+        "seconds": round(time.perf_counter() - start_time, 3),
+        "best_z": best_sample_z,
+        "best_score": best_focus_score,
+        "fitted_z": best_z_pos,
+    })
+    if focus_map is not None:
+        focus_map.add(stage_x, stage_y, best_z_pos, best_focus_score, measured=not predicted)
+    return best_z_pos
 
 '''
 def snap(cam, y, x):
@@ -242,58 +335,100 @@ def snap(cam, y, x):
                 img.Release()
 '''
 
-current_z_position_steps = 0
-
-# Main loop with autofocus
-for y in range(y_step_count):
-    print(f"\n--- Starting row {y}, performing autofocus ---")
-    current_z_position_steps = autofocus(
-        cam,
-        "http://192.168.1.70/z_move",
-        autofocus_range,
-        autofocus_step_size,
-    )
-    print(f"Autofocus completed for row {y}. Current Z-position: {current_z_position_steps}")
-
-    combine_exposures(
-        cam,
-        y, x_coord,
-        "http://192.168.1.70/z_move",
-        autofocus_range,
-        autofocus_step_size,
-    ) # Take the first combined exposure after autofocus
-
-    x_dir = x_dir*-1
-    for x in range(x_step_count-1):
-
-        x_coord = x_coord + x_dir
-
-        # Advance in x in alternating directions
-        if x_dir == 1:
-            urllib.request.urlopen("http://192.168.1.70/x_move?steps="+str(x_step_size)+"&dir=pos").read()
-        else:
-            urllib.request.urlopen("http://192.168.1.70/x_move?steps="+str(x_step_size)+"&dir=neg").read()
-
-        time.sleep(1)
-        current_z_position_steps = autofocus(
-            cam,
-            "http://192.168.1.70/z_move",
-            autofocus_range,
-            autofocus_step_size,
-        )
-        print(f"Autofocus completed for combined exposure {x}. Current Z-position: {current_z_position_steps}")
-        combine_exposures(
-            cam,
-            y, x_coord,
-            "http://192.168.1.70/z_move",
-            autofocus_range,
-            autofocus_step_size,
-        )
-
-    # Advance in y
-    urllib.request.urlopen("http://192.168.1.70/y_move?steps="+str(y_step_size)+"&dir=neg").read()
+if __name__ == "__main__":
+    preview = Preview(preview_fps, preview_scale) if preview_fps > 0 else None
+    if camera_backend == "synthetic":
+        x_stage, y_stage, z_stage = SimulatedStage("x"), SimulatedStage("y"), SimulatedStage("z")
+        cam = SyntheticCamera(z_stage, x_stage, y_stage, tilt=(0.2, -0.1), preview=preview,
+                              buffers=hdr_brackets+6, exposure_us=exposure_us,
+                              pixel_format="BayerRG8" if raw_capture else "BGR8")
+    else:
+        x_stage = StageAxis("http://192.168.1.70/x_move")
+        y_stage = StageAxis("http://192.168.1.70/y_move")
+        z_stage = StageAxis("http://192.168.1.70/z_move")
+        cam = PylonCamera(exposure_us=exposure_us, gain_raw=gain_raw, preview=preview, buffers=hdr_brackets+6,
+                          burst_buffers=burst_buffers, raw=raw_capture)
+
+
+    # Raw Bayer frames are scored on their green sites
+    focus_score.pixel_format = cam.pixel_format
+    # Captures and scores autofocus frames, reduced frames while focusing a tile
+    focus_frames = FocusFrames(cam, focus_score, focus_camera_frames)
+
+    timestr = time.strftime("%Y%m%d-%H%M%S")
+    if not os.path.exists(timestr):
+        os.makedirs(timestr)
+
+    x_dir = -1 # For snake-like back n forth movement
+    x_coord = 0 # At what step we are for file naming
+
+    if cam.burst is not None:
+        cam.burst.log_path = f'{timestr}/burst_frames.csv'
+    # Waits out the vibration after every stage move
+    if settle_table is not None:
+        settle = SettleTable.load(settle_table)
+    else:
+        settle = SettleDetector(settle_threshold, pixel_format=cam.pixel_format, log_path=f'{timestr}/settle_times.csv')
+    fusion_pool = FusionPool(fusion_workers, fusion_mode, height_maps=save_height_maps, png_level=png_compression) if fusion_workers > 0 else None
+    slice_aligner = SliceAligner(bayer=is_bayer(cam.pixel_format)) if register_slices else None
+
+    if autofocus_strategy == "continuous":
+        # Needs the Basler camera and the stage firmware that reports move timing
+        from continuous_sweep import ContinuousSweep
+        autofocus_search = ContinuousSweep(autofocus_range, cam.camera, focus_frames.score_result,
+                                            tracker=cam.tracker)
+    else:
+        autofocus_search = make_search(autofocus_strategy, autofocus_range, autofocus_step_size)
+    focus_map = FocusMap(verify_step=autofocus_step_size//2, residual_threshold=autofocus_step_size//4) if use_focus_map else None
 
+    # Every autofocus is centred on the previous tile's focus
+    current_z_position_steps = None
 
-# Cleanup
-cam.StopGrabbing()
-cam.Close()
+    # Main loop with autofocus
+    for y in range(y_step_count):
+        print(f"\n--- Starting row {y}, performing autofocus ---")
+        current_z_position_steps = scan_tile(
+            cam,
+            y, x_coord,
+            z_stage,
+            current_z_position_steps,
+        ) # Take the first combined exposure after autofocus
+        print(f"Autofocus completed for row {y}. Current Z-position: {current_z_position_steps}")
+
+        x_dir = x_dir*-1
+        for x in range(x_step_count-1):
+
+            x_coord = x_coord + x_dir
+
+            # Advance in x in alternating directions
+            x_stage.move(x_dir*x_step_size)
+
+            settle.wait(cam, "x", x_dir*x_step_size)
+            current_z_position_steps = scan_tile(
+                cam,
+                y, x_coord,
+                z_stage,
+                current_z_position_steps,
+            )
+            print(f"Autofocus completed for combined exposure {x}. Current Z-position: {current_z_position_steps}")
+
+        # Advance in y
+        y_stage.move(-y_step_size)
+        settle.wait(cam, "y", -y_step_size)
+
+
+    # Cleanup
+    cam.report()
+    settle.report()
+    if settle_table is None:
+        settle.save(timestr+"/settle_table.json")
+    focus_frames.report()
+    if focus_map is not None:
+        print(f"Focus map: {focus_map.measured_tiles} tiles autofocused, {focus_map.predicted_tiles} from prediction")
+    if fusion_pool is not None:
+        fusion_pool.shutdown()
+    if slice_aligner is not None:
+        slice_aligner.save(f'{timestr}/slice_registration.json')
+    cam.close()
+    if preview is not None:
+        preview.close()
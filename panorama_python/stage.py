@@ -0,0 +1,83 @@
+import time
+import urllib.request
+
+
+# Thin client for one axis of the Pico W stepper web server
+# (xy_stage_mw_ek14/µcontroller_fw/picow_web_stepper). Moves are relative on
+# the wire; the page sent back after every move carries the new position,
+# which is tracked here so callers can move to absolute positions.
+#
+# Firmware that reports move timing (ticks_ms at the first and last step)
+# also gets the span of the last move mapped onto time.perf_counter(), so
+# the position during a move can be interpolated.
+
+ticks_period = 2**30  # time.ticks_ms() wraps at this on the RP2040
+
+
+def parse_field(html_content, field_id):
+    # Integer content of <span id="field_id">, None if the page has no such span
+    start_tag = f'<span id="{field_id}">'
+    end_tag = '</span>'
+    start_index = html_content.find(start_tag)
+    if start_index < 0:
+        return None
+    end_index = html_content.find(end_tag, start_index)
+    return int(html_content[start_index + len(start_tag):end_index])
+
+
+def parse_position(html_content, axis):
+    position = parse_field(html_content, f"{axis}_pos")
+    if position is None:
+        raise ValueError(f"No {axis} position in stage response")
+    return position
+
+
+class StageAxis:
+
+    def __init__(self, url_base):
+        # e.g. "http://192.168.1.70/z_move"
+        self.url_base = url_base
+        self.axis = url_base.rstrip("/").rsplit("/", 1)[-1].split("_")[0]
+        self.position = None
+        self.moves = 0
+        self.last_move = None  # {"start", "end", "from", "to"} in perf_counter seconds and steps
+
+    def _request(self, url):
+        with urllib.request.urlopen(url) as response:
+            html_content = response.read().decode('utf-8')
+        received = time.perf_counter()
+        self.position = parse_position(html_content, self.axis)
+        self.last_move = self._move_timing(html_content, received)
+        return self.position
+
+    def _move_timing(self, html_content, received):
+        now = parse_field(html_content, "ticks_now")
+        start = parse_field(html_content, f"{self.axis}_move_start")
+        end = parse_field(html_content, f"{self.axis}_move_end")
+        if now is None or start is None or end is None:
+            return None
+        # The page is generated right before it is sent, so the stage's
+        # ticks_now is taken as the moment the reply arrived here
+        return {
+            "start": received - ((now - start) % ticks_period) / 1000,
+            "end": received - ((now - end) % ticks_period) / 1000,
+            "from": parse_field(html_content, f"{self.axis}_move_from"),
+            "to": self.position,
+        }
+
+    def read_position(self):
+        # A move request without steps only returns the page
+        return self._request(self.url_base)
+
+    def move(self, steps):
+        steps = int(steps)
+        if steps == 0:
+            return self.position if self.position is not None else self.read_position()
+        direction = "pos" if steps > 0 else "neg"
+        self.moves += 1
+        return self._request(f"{self.url_base}?steps={abs(steps)}&dir={direction}")
+
+    def move_to(self, target):
+        if self.position is None:
+            self.read_position()
+        return self.move(int(target) - self.position)
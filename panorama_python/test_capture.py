@@ -0,0 +1,139 @@
+import sys
+import types
+import unittest
+
+try:
+    from pypylon import pylon
+except ImportError:
+    # capture.py only needs the timeout handling constants from pylon
+    pylon = types.SimpleNamespace(TimeoutHandling_Return=0, TimeoutHandling_ThrowException=1)
+    sys.modules["pypylon"] = types.SimpleNamespace(pylon=pylon)
+
+from capture import BurstCapture, FrameTracker
+
+
+# BurstCapture against a fake software-triggered camera that numbers its
+# frames like a Basler camera and loses the ones it is told to drop.
+
+class FakeResult:
+
+    def __init__(self, block_id):
+        self.BlockID = block_id
+        self.TimeStamp = block_id * 1000
+
+    def IsValid(self):
+        return self.BlockID is not None
+
+    def GrabSucceeded(self):
+        return True
+
+    def GetErrorDescription(self):
+        return ""
+
+    def Release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Release()
+
+
+class FakeWaitObject:
+
+    def __init__(self, camera):
+        self.camera = camera
+
+    def Wait(self, timeout_ms):
+        return bool(self.camera.queue)
+
+
+class FakeValue:
+
+    def __init__(self, value):
+        self.value = value
+
+    def GetValue(self):
+        return self.value
+
+
+class FakeNodeMap:
+
+    def GetNode(self, name):
+        return name
+
+
+class FakeCamera:
+
+    def __init__(self, next_id=1):
+        self.next_id = next_id
+        self.drop = set()  # Block IDs that never arrive
+        self.queue = []
+        self.ExposureTimeAbs = FakeValue(1000)
+
+    def restart(self, next_id=1):
+        # StartGrabbing after a geometry switch, the block IDs start over
+        self.queue = []
+        self.next_id = next_id
+
+    def GetNodeMap(self):
+        return FakeNodeMap()
+
+    def WaitForFrameTriggerReady(self, timeout_ms, handling):
+        return True
+
+    def ExecuteSoftwareTrigger(self):
+        block_id = self.next_id
+        self.next_id += 1
+        if block_id not in self.drop:
+            self.queue.append(FakeResult(block_id))
+
+    def RetrieveResult(self, timeout_ms, handling):
+        return self.queue.pop(0) if self.queue else FakeResult(None)
+
+    def GetGrabResultWaitObject(self):
+        return FakeWaitObject(self)
+
+
+def take_stack(burst, label, z_positions):
+    burst.start(label)
+    for z in z_positions:
+        burst.trigger(z)
+    return [(index, z) for result, index, z in burst.finish()]
+
+
+class BurstCaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.camera = FakeCamera(next_id=500)
+        self.tracker = FrameTracker()
+        self.burst = BurstCapture(self.camera, self.tracker)
+
+    def test_complete_stack(self):
+        slices = take_stack(self.burst, "tile", [0, 10, 20])
+        self.assertEqual(slices, [(0, 0), (1, 10), (2, 20)])
+        self.assertEqual(self.burst.dropped, 0)
+
+    def test_drop_inside_stack(self):
+        take_stack(self.burst, "first", [0])
+        self.camera.drop = {self.camera.next_id + 1}
+        slices = take_stack(self.burst, "tile", [0, 10, 20])
+        self.assertEqual(slices, [(0, 0), (2, 20)])
+        self.assertEqual(self.burst.dropped, 1)
+
+    def test_drop_at_first_slice_after_reset(self):
+        take_stack(self.burst, "first", [0, 10])
+        # configure_frames() restarts grabbing and resets the tracker
+        self.camera.restart()
+        self.tracker.reset()
+        # The first frame after the restart seeds the tracker, the one
+        # after it is slice 0
+        self.camera.drop = {2}
+        slices = take_stack(self.burst, "tile", [0, 10, 20, 30])
+        self.assertEqual(slices, [(1, 10), (2, 20), (3, 30)])
+        self.assertEqual(self.burst.dropped, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
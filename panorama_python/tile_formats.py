@@ -0,0 +1,111 @@
+import json
+import os
+import cv2
+import numpy as np
+
+
+# Output formats for tiles and fused images, picked by file extension:
+#
+#   .png   lossless, small, but slow to encode for multi-megapixel frames;
+#          png_level trades size for speed (0 = store, 9 = smallest)
+#   .tiff  uncompressed, about as fast as a memory copy, readable by
+#          stitching tools
+#   .npy   raw array plus a .json sidecar for metadata, fastest to read back
+#          into NumPy
+#
+# ScanStore keeps a whole scan in one chunked container instead of one
+# file per tile. benchmark_tile_formats.py measures the trade-off.
+
+tile_formats = ("png", "tiff", "npy")
+
+
+def write_tile(path, frame, png_level=1, meta=None):
+    extension = path.rsplit(".", 1)[-1].lower()
+    if extension == "npy":
+        np.save(path, frame)
+        if meta is not None:
+            with open(path[:-len(".npy")] + ".json", "w") as f:
+                json.dump(meta, f)
+        return path
+
+    if extension == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, png_level]
+    elif extension in ("tif", "tiff"):
+        params = [cv2.IMWRITE_TIFF_COMPRESSION, 1]  # 1 = no compression
+    else:
+        raise ValueError(f"Unknown tile format '{extension}', expected one of {tile_formats}")
+    if not cv2.imwrite(path, frame, params):
+        raise IOError(f"cv2.imwrite could not write {path}")
+    return path
+
+
+def read_tile(path):
+    if path.lower().endswith(".npy"):
+        return np.load(path)
+    return cv2.imread(path, cv2.IMREAD_UNCHANGED)
+
+
+class MemmapStore:
+    # Shared close() of the memory-mapped stores: subclasses keep their
+    # data in self.array and describe it in header(), which goes to the
+    # JSON sidecar <path>.json.
+
+    def write_header(self):
+        # Replace atomically so a reader never sees a half-written header
+        with open(self.path + ".json.tmp", "w") as f:
+            json.dump(self.header(), f)
+        os.replace(self.path + ".json.tmp", self.path + ".json")
+
+    def close(self):
+        if self.array is None:
+            return
+        self.array.flush()
+        self.write_header()
+        self.array = None
+
+
+class ScanStore(MemmapStore):
+    # One memory-mapped file (<path>.raw) for all tiles of a scan, laid out
+    # rows x cols x height x width x channels so every tile is one
+    # contiguous chunk, plus a JSON sidecar (<path>.json) with the layout,
+    # which tiles are filled and their metadata. The file is sparse until
+    # tiles are written, the space for unvisited tiles costs nothing.
+
+    def __init__(self, path, rows, cols):
+        self.path = path
+        self.rows = rows
+        self.cols = cols
+        self.array = None
+        self.tiles = {}  # "y,x" -> metadata of every written tile
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def write(self, y, x, frame, meta=None):
+        if self.array is None:
+            shape = (self.rows, self.cols) + frame.shape
+            self.array = np.memmap(self.path + ".raw", dtype=frame.dtype, mode="w+", shape=shape)
+        self.array[y, x] = frame
+        self.tiles[f"{y},{x}"] = meta or {}
+
+    def read(self, y, x):
+        if f"{y},{x}" not in self.tiles:
+            raise KeyError(f"Tile y{y}_x{x} not in scan store")
+        return self.array[y, x]
+
+    def header(self):
+        return {
+            "shape": list(self.array.shape),
+            "dtype": self.array.dtype.str,
+            "tiles": self.tiles,
+        }
+
+    @classmethod
+    def open(cls, path, mode="r"):
+        with open(path + ".json") as f:
+            header = json.load(f)
+        shape = tuple(header["shape"])
+        store = cls(path, shape[0], shape[1])
+        store.array = np.memmap(path + ".raw", dtype=header["dtype"], mode=mode, shape=shape)
+        store.tiles = header["tiles"]
+        return store
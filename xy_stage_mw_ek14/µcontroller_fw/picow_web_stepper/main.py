@@ -47,7 +47,10 @@ axes = {
         'invert': X_INVERT,
         'min': X_MIN,
         'max': X_MAX,
-        'homing_active': 0
+        'homing_active': 0,
+        'move_start': 0,
+        'move_end': 0,
+        'move_from': 0
     },
     'y': {
         'en': Pin(Y_EN_PIN, Pin.OUT),
@@ -59,7 +62,10 @@ axes = {
         'invert': Y_INVERT,
         'min': Y_MIN,
         'max': Y_MAX,
-        'homing_active': 0
+        'homing_active': 0,
+        'move_start': 0,
+        'move_end': 0,
+        'move_from': 0
     },
     'z': {
         'en': Pin(Z_EN_PIN, Pin.OUT),
@@ -71,7 +77,10 @@ axes = {
         'invert': Z_INVERT,
         'min': Z_MIN,
         'max': Z_MAX,
-        'homing_active': 0
+        'homing_active': 0,
+        'move_start': 0,
+        'move_end': 0,
+        'move_from': 0
     }
 }
 
@@ -147,10 +156,15 @@ def move_stepper(axis_name, num_steps):
     dir_pin.value(dirpinval ^ axis['invert'])
     time.sleep_ms(DELAY_MS) # Delay after changing direction
 
+    # Time span of the actual stepping, reported on the page so the host can
+    # interpolate the position during the move (continuous autofocus sweeps)
+    axis['move_from'] = axis['position']
+    axis['move_start'] = time.ticks_ms()
     for _ in range(abs_steps):
         do_step(axis, direction)
         # Optional: Add a small delay here if steps are too fast
         # time.sleep_us(100) # Example: 100 microseconds delay between steps
+    axis['move_end'] = time.ticks_ms()
 
     print(f"{axis_name} final position: {axis['position']}")
 
@@ -194,6 +208,14 @@ def web_page():
     y_pos = axes['y']['position']
     z_pos = axes['z']['position']
 
+    # Timing of the last move per axis in time.ticks_ms(), with the current
+    # ticks so the host can relate them to its own clock
+    move_timing = f'<span id="ticks_now">{time.ticks_ms()}</span>'
+    for name, axis in axes.items():
+        move_timing += f'<span id="{name}_move_start">{axis["move_start"]}</span>'
+        move_timing += f'<span id="{name}_move_end">{axis["move_end"]}</span>'
+        move_timing += f'<span id="{name}_move_from">{axis["move_from"]}</span>'
+
     html = f"""
     <html>
     <head>
@@ -302,6 +324,8 @@ def web_page():
                 <a href="/z_neg_1"><button class="button red">Z Step -</button></a>
             </div>
         </div>
+
+        <div hidden>{move_timing}</div>
     </body>
     </html>
     """